@@ -1,32 +1,142 @@
 from flask import (Flask, request, make_response, render_template, flash, g,
-                   url_for, redirect, jsonify, abort, g)
+                   url_for, redirect, jsonify, abort, g, Response,
+                   stream_with_context, send_file)
 from flask import session as cookie_session
 
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import (sessionmaker, scoped_session,
+                            make_transient_to_detached)
 
 from functools import wraps
 
-import requests
+import os
 import random
 import string
 import json
 import time
-
-from database_setup import Base, User, Category, Item
+import calendar
+import hashlib
+
+from database_setup import (Base, User, Category, Item, DATABASE_URL,
+                            create_db_engine)
+import queries
+from queries import QueryCounter, QueryBudgetExceeded
+from cache import create_cache
+from search import search_items
+from category_stats import last_item_at_of
+from providers import GoogleClient, FacebookClient, ProviderError
+from jobs import enqueue
+import avatars
+import metrics
+from templating import configure_templates
+from sessions import ServerSideSessionInterface
+from replicas import RoutingSession
+from ratelimit import create_limiter, retry_after
 
 # Initialize the app object
 app = Flask(__name__)
 
-# Connect to the database and obtain a session object
-engine = create_engine("sqlite:///catalog.db")
+# Connect to the database, CATALOG_DATABASE_URL or catalog.db. The pool can
+# be tuned through the environment
+POOL_OPTIONS = dict(
+    pool_size=int(os.environ.get("CATALOG_DB_POOL_SIZE", 5)),
+    max_overflow=int(os.environ.get("CATALOG_DB_MAX_OVERFLOW", 10)),
+    pool_timeout=int(os.environ.get("CATALOG_DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.environ.get("CATALOG_DB_POOL_RECYCLE", 3600)))
+engine = create_db_engine(DATABASE_URL, **POOL_OPTIONS)
 Base.metadata.bind = engine
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Reads of GET requests go to CATALOG_REPLICA_URL when it is set. For
+# REPLICA_LAG seconds after a user's last write, their reads go to the
+# primary instead so that they see their own changes
+REPLICA_URL = os.environ.get("CATALOG_REPLICA_URL")
+replica_engine = create_db_engine(REPLICA_URL, **POOL_OPTIONS) \
+    if REPLICA_URL else None
+REPLICA_LAG = float(os.environ.get("CATALOG_REPLICA_LAG", 10))
+
+# Load compiled templates from disk, see templating.py
+configure_templates(app)
+
+# Record request, SQL and template timings, served at /_metrics. Setting
+# CATALOG_PROFILE_SLOW_MS profiles a CATALOG_PROFILE_RATE fraction of requests
+# and saves those slower than that many milliseconds to CATALOG_PROFILE_DIR
+PROFILE_SLOW_MS = os.environ.get("CATALOG_PROFILE_SLOW_MS")
+metrics.instrument(
+    app,
+    profile_threshold=(float(PROFILE_SLOW_MS) / 1000
+                       if PROFILE_SLOW_MS else None),
+    profile_rate=float(os.environ.get("CATALOG_PROFILE_RATE", 0.01)),
+    profile_dir=os.environ.get("CATALOG_PROFILE_DIR", "profiles"))
+
+# Caches are private to this process unless CATALOG_CACHE_URL points at a
+# memcached server shared by every worker, e.g. "memcached://127.0.0.1:11211"
+CACHE_URL = os.environ.get("CATALOG_CACHE_URL", "memory://")
+
+# Rendered pages served to anonymous users
+page_cache = create_cache(
+    CACHE_URL, prefix="page:",
+    max_entries=int(os.environ.get("CATALOG_PAGE_CACHE_SIZE", 1000)),
+    ttl=int(os.environ.get("CATALOG_PAGE_CACHE_TTL", 300)))
+
+# User rows looked up by id and email, stored as dicts of their columns
+user_cache = create_cache(CACHE_URL, prefix="user:", max_entries=10000,
+                          ttl=3600)
+
+metrics.registry.add(metrics.Gauge(
+    "catalog_cache", "Cache sizes and hit/miss counters",
+    lambda: [(dict(cache=name, stat=stat), value)
+             for name, cache in (("page", page_cache), ("user", user_cache),
+                                 ("session", session_cache))
+             for stat, value in sorted(cache.stats().items())]))
+
+# Requests allowed per client, its session or else its IP address, as
+# "limit/seconds". GET and HEAD requests count against the read budget and
+# everything else against the write budget. Limits are enforced by each
+# process unless CATALOG_RATE_LIMIT_URL points at a shared memcached server
+RATE_LIMIT_URL = os.environ.get("CATALOG_RATE_LIMIT_URL", "memory://")
+rate_limiters = {
+    "read": create_limiter(
+        RATE_LIMIT_URL, os.environ.get("CATALOG_READ_RATE_LIMIT", "300/60"),
+        prefix="rate:read:"),
+    "write": create_limiter(
+        RATE_LIMIT_URL, os.environ.get("CATALOG_WRITE_RATE_LIMIT", "30/60"),
+        prefix="rate:write:"),
+}
+
+# Endpoints never rate limited. Avatars are requested by every page that
+# shows a user, and served from disk
+RATE_LIMIT_EXEMPT = ("static", "avatar", "metrics_page")
+
+rate_limited = metrics.registry.add(metrics.Counter(
+    "catalog_rate_limited_total", "Requests refused by the rate limits"))
+metrics.registry.add(metrics.Gauge(
+    "catalog_rate_limit", "Clients tracked and requests allowed and refused",
+    lambda: [(dict(budget=budget, stat=stat), value)
+             for budget, limiter in sorted(rate_limiters.items())
+             for stat, value in sorted(limiter.stats().items())]))
+
+# Headers stored with a cached page and replayed on every hit
+CACHED_PAGE_HEADERS = ("Content-Type", "ETag", "Last-Modified",
+                       "Cache-Control")
+
+# Each request gets its own session, opened in before_request and removed at
+# teardown, so requests on different threads never share a connection or an
+# identity map. Module-level code can keep using "session" as if it were a
+# plain session object.
+DBSession = sessionmaker(class_=RoutingSession, bind=engine,
+                         info={"replica": replica_engine})
+session = scoped_session(DBSession)
+
+# Session data is kept in the database, and the session cookie only holds its
+# id. Records are cached like pages, so share CATALOG_CACHE_URL between
+# processes for each to see the others' logins and logouts. They are always
+# read from the primary, as a lagging replica could undo a login
+session_cache = create_cache(CACHE_URL, prefix="session:", max_entries=10000,
+                             ttl=300)
+app.session_interface = ServerSideSessionInterface(lambda: session.bind,
+                                                   session_cache)
 
 
 def int_time():
@@ -34,34 +144,215 @@ def int_time():
     return int(time.time())
 
 
-def parse_query_string(query_string):
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.logged_in:
+            return abort(401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def query_budget(limit):
     """
-    Returns a dictionary of query string parameters
+    Limits the number of SQL statements a view may issue, template rendering
+    included, on the primary and the replica alike. Only enforced in debug
+    and testing mode, where going over the budget raises QueryBudgetExceeded
+    so that N+1 regressions fail loudly.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not (app.debug or app.testing):
+                return f(*args, **kwargs)
+
+            with QueryCounter() as counter:
+                result = f(*args, **kwargs)
+
+            if counter.count > limit:
+                raise QueryBudgetExceeded(
+                    "%s issued %d queries, budget is %d:\n%s" %
+                    (request.path, counter.count, limit,
+                     "\n".join(counter.statements)))
+            return result
+        return decorated_function
+    return decorator
+
+
+def cached_page(key):
+    """
+    Serves a view from page_cache for anonymous users. key is a format string
+    filled in from the view's arguments, e.g. "item:%(item_id)d". Logged in
+    users and pages with a pending flash message bypass the cache, and only
+    successful responses are stored.
+
+    A page is stored with the generations it depends on, see
+    depend_on_generation(), and rendered again once any of them is evicted.
+    Its own generation is read before rendering, so a change evicted while
+    the page is rendered is never hidden by storing the old page.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(**kwargs):
+            if g.logged_in or "_flashes" in cookie_session:
+                return f(**kwargs)
+
+            cache_key = key % kwargs
+            cached = page_cache.get(cache_key)
+            if cached is not None:
+                body, headers, generations = cached
+                if all(page_cache.get(generation) == value
+                       for generation, value in generations):
+                    response = app.response_class(body, headers=headers)
+                    return response.make_conditional(request)
+
+            generation = "generation:" + cache_key
+            evicted_at = page_cache.get("evicted_at")
+            g.page_generations = [(generation, start_generation(generation))]
+            g.page_started_generation = False
+            response = make_response(f(**kwargs))
+            if response.status_code != 200 or replica_may_be_stale():
+                return response
+            # A generation started while rendering may be new because it was
+            # evicted after the page read its data
+            if g.page_started_generation and \
+                    page_cache.get("evicted_at") != evicted_at:
+                return response
+
+            headers = [(name, response.headers[name])
+                       for name in CACHED_PAGE_HEADERS
+                       if name in response.headers]
+            page_cache.set(cache_key,
+                           (response.get_data(), headers, g.page_generations))
+            return response
+        return decorated_function
+    return decorator
+
+
+def start_generation(key):
+    """ Returns the value of generation key, starting one if there is none """
+    value = page_cache.get(key)
+    if value is None:
+        value = random.getrandbits(64)
+        page_cache.set(key, value)
+    return value
+
+
+def depend_on_generation(key):
+    """
+    Has the page being rendered by cached_page() stored with generation key,
+    so that evicting key evicts it, along with every other page depending on
+    it. Should the generation have to be started, the page is only stored
+    if nothing was evicted while it was rendered.
+    """
+    value = page_cache.get(key)
+    if value is None:
+        value = start_generation(key)
+        g.page_started_generation = True
+    if g.get("page_generations") is not None:
+        g.page_generations.append((key, value))
 
-    Used for parsing results from certain Facebook APIs that return results in
-    a query string format.
+
+def evict_pages(category_ids=(), item_ids=(), item_pages_of=()):
+    """
+    Removes the home page and the pages of the given categories and items from
+    page_cache, along with every item page of the categories in
+    item_pages_of. Called after committing a change that affects them.
     """
+    pages = ["index"]
+    pages.extend("category:%d" % category_id for category_id in category_ids)
+    pages.extend("item:%d" % item_id for item_id in item_ids)
+    keys = pages + ["generation:" + page for page in pages]
+    keys.extend("generation:category:%d" % category_id
+                for category_id in item_pages_of)
+    page_cache.delete(*keys)
+    page_cache.set("evicted_at", time.time())
 
-    parameters = query_string.split("&")
-    result = {}
 
-    for parameter in parameters:
-        parameter_parts = parameter.split("=", 1)
-        if len(parameter_parts) != 2:
-            continue
+def replica_may_be_stale():
+    """
+    Whether this request reads from a replica that may not have caught up
+    with the last evicted change yet. Pages rendered from it are not cached,
+    or they would keep showing the old data after the replica catches up.
+    """
+    if session.info.get("replica") is None or session.info.get("use_primary"):
+        return False
+    evicted_at = page_cache.get("evicted_at")
+    return evicted_at is not None and evicted_at > time.time() - REPLICA_LAG
 
-        result[parameter_parts[0]] = parameter_parts[1]
 
-    return result
+def page_args():
+    """
+    Returns the (after_id, limit) keyset pagination parameters of the current
+    request, with limit clamped to [1, MAX_PAGE_SIZE]
+    """
+    after_id = request.args.get("after_id", 0, type=int)
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    return after_id, max(1, min(limit, MAX_PAGE_SIZE))
 
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not g.logged_in:
-            return abort(401)
-        return f(*args, **kwargs)
-    return decorated_function
+def search_page_args():
+    """
+    Returns the (text, page, limit) parameters of a search request. Search
+    results are ranked rather than ordered by id, so they are paged by number
+    """
+    text = request.args.get("q", "")
+    page = max(1, request.args.get("page", 1, type=int))
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    return text, page, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def next_after_id(rows, limit):
+    """ The after_id of the page following rows, or None on the last page """
+    if len(rows) < limit:
+        return None
+    return rows[-1].id
+
+
+def ndjson_response(rows):
+    """ Streams an iterable of dicts as newline-delimited JSON """
+    def generate():
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    return Response(stream_with_context(generate()),
+                    mimetype="application/x-ndjson")
+
+
+def add_validators(response, etag, last_modified):
+    """
+    Sets a weak ETag and Last-Modified on a response. Clients are asked to
+    revalidate every time, which is cheap since a match is answered with 304.
+    """
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if g.logged_in:
+        response.cache_control.private = True
+    return response
+
+
+def not_modified(etag, last_modified):
+    """
+    Returns a 304 response if the client's copy, identified by its
+    If-None-Match or If-Modified-Since header, is still current, else None.
+
+    Pages are never treated as cached while a flash message is waiting to be
+    shown, since the message would otherwise be lost.
+    """
+    if "_flashes" in cookie_session:
+        return None
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        fresh = last_modified <= since
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return add_validators(make_response("", 304), etag, last_modified)
 
 
 def error_response(error, status):
@@ -77,20 +368,104 @@ def read_json(filename):
     return result
 
 
+def read_client_secrets(filename):
+    """ Returns the "web" section of an OAuth client secrets file """
+    if filename not in client_secrets:
+        client_secrets[filename] = read_json(filename)["web"]
+    return client_secrets[filename]
+
+
 # DB interaction tools
+def email_key(email):
+    """ A user_cache key for an email address, safe for any backend """
+    return "email:" + hashlib.sha1(email.encode("utf-8")).hexdigest()
+
+
+def cache_user(user):
+    """ Stores a user in user_cache under both its id and email """
+    data = {"id": user.id, "email": user.email, "name": user.name,
+            "picture": user.picture}
+    user_cache.set("id:%d" % user.id, data)
+    user_cache.set(email_key(user.email), data)
+
+
+def user_from_cache(data):
+    """
+    Turns a dict from user_cache back into a User attached to the session,
+    without querying the database
+    """
+    user = User(**data)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
+
+
 def get_user_by_email(email):
     """ Gets a user object by the unique email key """
+    data = user_cache.get(email_key(email))
+    if data is not None:
+        return user_from_cache(data)
+
     try:
         user = session.query(User).filter_by(email=email).one()
-        return user
     except:
         # The specified user could not be found
         return None
 
+    cache_user(user)
+    return user
+
 
 def get_user_by_id(id):
-    """ Get user by the ID in the database """
-    return session.query(User).filter_by(id=id).one()
+    """ Get user by the ID in the database, or None if there is none """
+    data = user_cache.get("id:%d" % id)
+    if data is not None:
+        return user_from_cache(data)
+
+    user = session.query(User).filter_by(id=id).first()
+    if user is not None:
+        cache_user(user)
+    return user
+
+
+def touch(model, ids):
+    """
+    Records a change to the rows of model with the given ids by bumping their
+    version and timestamp. The increment is done in SQL so that concurrent
+    changes made by other workers are never lost.
+    """
+    session.query(model).filter(model.id.in_(ids)).update(
+        {model.version: model.version + 1, model.timestamp: int_time()},
+        synchronize_session=False)
+
+
+def is_live_category(category_id):
+    """ Whether a category exists and has not been deleted """
+    return queries.live_categories(session).filter_by(
+        id=category_id).count() > 0
+
+
+def update_item_stats(category_id, added):
+    """
+    Maintains Category.item_count and last_item_at after added items were
+    added to a category, or removed when negative. With added=0 an item in
+    the category was edited in place. Removals recompute last_item_at from the
+    newest remaining item, so they must be flushed first.
+    """
+    if added >= 0:
+        last_item_at = int_time()
+    else:
+        last_item_at = last_item_at_of(category_id)
+
+    session.query(Category).filter_by(id=category_id).update(
+        {Category.item_count: Category.item_count + added,
+         Category.last_item_at: last_item_at},
+        synchronize_session=False)
+
+
+def cache_avatar(user_id):
+    """ Has worker.py download and cache a user's picture after a login """
+    enqueue(session, "cache_avatar", user_id)
+    session.commit()
 
 
 def create_user(email, name, picture):
@@ -98,63 +473,231 @@ def create_user(email, name, picture):
     new_user = User(email=email, name=name, picture=picture)
     session.add(new_user)
     session.commit()
+    cache_user(new_user)
     return new_user
 
 
-# Used in the OAuth processes
-GOOGLE_CLIENT_ID = read_json("google_client_secrets.json")["web"]["client_id"]
-FACEBOOK_APP_DATA = read_json("facebook_client_secrets.json")
+# Seconds browsers may cache an avatar. Versioned avatar URLs, which change
+# along with the picture, are cached for a year
+AVATAR_MAX_AGE = 3600
+AVATAR_VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+# Let a front end server such as nginx or Apache send avatar files, by
+# responding with only an X-Sendfile header naming the file
+app.use_x_sendfile = os.environ.get("CATALOG_USE_X_SENDFILE") == "1"
+
+# Categories with at least this many items are hidden when deleted and
+# purged in the background, smaller ones are deleted at once
+SOFT_DELETE_MIN_ITEMS = int(os.environ.get("CATALOG_SOFT_DELETE_MIN_ITEMS",
+                                           1000))
+
+# Page sizes for the paginated JSON APIs
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# OAuth client secrets by filename, each read on first use
+client_secrets = {}
+
+# Provider API clients, whose connections are reused across logins
+google = GoogleClient()
+facebook = FacebookClient()
+
+
+@app.before_request
+def rate_limit():
+    """
+    Refuses requests over the client's read or write budget with a 429.
+    Registered first, so that refused requests never load their user.
+    """
+    if request.endpoint in RATE_LIMIT_EXEMPT:
+        return
+    budget = "read" if request.method in ("GET", "HEAD") else "write"
+    limiter = rate_limiters.get(budget)
+    if limiter is None:
+        return
+
+    # Only a session that exists identifies a client, as anyone can make up
+    # a cookie
+    if cookie_session.sid is not None:
+        client = "session:%s" % cookie_session.sid
+    else:
+        client = "ip:%s" % request.remote_addr
+    wait = limiter.hit(client)
+    if wait:
+        rate_limited.inc(budget=budget)
+        return abort(429, retry_after=retry_after(wait))
 
 
 @app.before_request
 def before_request():
-    """ Sets logged_in and user_id onto Flask"s g object for convenience """
+    """
+    Sets logged_in, user_id and user onto Flask"s g object for convenience.
+    user comes from user_cache, so usually costs no query.
+    """
+    g.db = session()
+    session.info["use_primary"] = request.method not in ("GET", "HEAD") or \
+        cookie_session.get("primary_until", 0) > time.time()
     g.logged_in = cookie_session.get("email") is not None
     g.user_id = cookie_session.get("user_id")
+    g.user = get_user_by_id(g.user_id) if g.user_id is not None else None
+
+    # The user was deleted since logging in
+    if g.user_id is not None and g.user is None:
+        cookie_session.clear()
+        g.logged_in = False
+        g.user_id = None
+
+
+@app.after_request
+def remember_writes(response):
+    """
+    Sends the reads of a user who just changed something to the primary for
+    REPLICA_LAG seconds, until the replica has caught up with the change
+    """
+    if session.info.get("replica") is not None and \
+            request.method not in ("GET", "HEAD") and \
+            response.status_code < 400:
+        cookie_session["primary_until"] = time.time() + REPLICA_LAG
+    return response
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """ Closes the request"s session and returns its connection to the pool """
+    session.remove()
+
+
+@app.route("/_metrics")
+def metrics_page():
+    """ Request, SQL, template and cache metrics for Prometheus """
+    return Response(metrics.registry.render(),
+                    mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/api/categories.json")
+@query_budget(1)
 def catalog_json():
-    """ JSON API for accessing all categories """
-    categories = session.query(Category).all()
-    return jsonify(categories=[x.serialize for x in categories])
+    """
+    JSON API for accessing categories, one page at a time in order of id.
+    Pass the returned next_after_id as after_id to get the next page.
+    """
+    after_id, limit = page_args()
+    categories = queries.keyset_page(queries.live_categories(session),
+                                     Category.id, after_id, limit).all()
+    return jsonify(categories=[x.serialize for x in categories],
+                   next_after_id=next_after_id(categories, limit))
+
+
+@app.route("/api/categories.ndjson")
+def catalog_ndjson():
+    """ Streams every category as newline-delimited JSON """
+    categories = queries.stream(queries.live_categories(session)
+                                .order_by(Category.id))
+    return ndjson_response(x.serialize for x in categories)
 
 
 @app.route("/api/category/<int:category_id>.json")
+@query_budget(2)
 def category_json(category_id):
-    """ JSON API for accessing a specific category and its items """
+    """
+    JSON API for accessing a specific category and a page of its items, which
+    is paginated the same way as the category list
+    """
     try:
-        category = session.query(Category).filter_by(id=category_id).one()
+        category = queries.live_categories(session) \
+            .filter_by(id=category_id).one()
     except:
         return abort(404)
 
-    items = session.query(Item).filter_by(category_id=category_id).all()
+    # The category's version also changes whenever one of its items does
+    etag = "category-%d-%d-%d" % (category.id, category.version,
+                                  category.timestamp)
+    cached = not_modified(etag, category.timestamp)
+    if cached is not None:
+        return cached
+
+    after_id, limit = page_args()
+    items = queries.keyset_page(queries.category_items(session, category_id),
+                                Item.id, after_id, limit).all()
 
     items_dict = [item.serialize for item in items]
     category_dict = category.serialize
     category_dict["items"] = items_dict
 
-    return jsonify(category=category_dict)
+    response = jsonify(category=category_dict,
+                       next_after_id=next_after_id(items, limit))
+    return add_validators(response, etag, category.timestamp)
+
+
+@app.route("/api/category/<int:category_id>.ndjson")
+def category_ndjson(category_id):
+    """
+    Streams a category as newline-delimited JSON. The first line is the
+    category and every following line is one of its items.
+    """
+    try:
+        category = queries.live_categories(session) \
+            .filter_by(id=category_id).one()
+    except:
+        return abort(404)
+
+    items = queries.stream(queries.category_items(session, category_id)
+                           .order_by(Item.id))
+
+    def rows():
+        yield category.serialize
+        for item in items:
+            yield item.serialize
+
+    return ndjson_response(rows())
 
 
 @app.route("/api/item/<int:item_id>.json")
+@query_budget(1)
 def item_json(item_id):
     """ JSON API for accessing a specific item """
     try:
-        item = session.query(Item).filter_by(id=item_id).one()
+        item = queries.item_by_id(session, item_id).one()
     except:
         return abort(404)
 
-    return jsonify(item=item.serialize)
+    etag = "item-%d-%d-%d" % (item.id, item.version, item.timestamp)
+    cached = not_modified(etag, item.timestamp)
+    if cached is not None:
+        return cached
+
+    return add_validators(jsonify(item=item.serialize), etag, item.timestamp)
+
+
+@app.route("/api/search.json")
+def search_json():
+    """ JSON API for searching items by name and description """
+    text, page, limit = search_page_args()
+    items = search_items(session, text).offset((page - 1) * limit) \
+        .limit(limit).all()
+    return jsonify(items=[item.serialize for item in items],
+                   next_page=page + 1 if len(items) == limit else None)
+
+
+@app.route("/search")
+def search():
+    """ Shows a page of items matching the search text """
+    text, page, limit = search_page_args()
+    items = search_items(session, text).offset((page - 1) * limit) \
+        .limit(limit).all()
+    return render_template("search.html", q=text, items=items, page=page,
+                           has_next=len(items) == limit)
 
 
 @app.route("/category/")
 @app.route("/")
+@query_budget(2)
+@cached_page("index")
 def index():
     """ Returns home page with category list and 10 newest items """
 
-    categories = session.query(Category).order_by(desc(Category.id)).all()
-    latest_items = session.query(Item).order_by(desc(Item.id)).limit(10).all()
+    categories = queries.all_categories(session).all()
+    latest_items = queries.latest_items(session, 10).all()
     return render_template("categories.html", categories=categories,
                            items=latest_items)
 
@@ -174,23 +717,26 @@ def create_category():
 
         session.add(new_category)
         session.commit()
+        evict_pages()
         flash("Category \"%s\" created" % category_name)
 
     return redirect(url_for("index"))
 
 
 @app.route("/category/<int:category_id>")
+@query_budget(2)
+@cached_page("category:%(category_id)d")
 def show_category(category_id):
     """
     Shows a category and its items. Options for editing and deleting are shown
     if the user is logged in and matches the user id of a given category.
     """
     try:
-        category = session.query(Category).filter_by(id=category_id).one()
+        category = queries.category_by_id(session, category_id).one()
     except:
         return abort(404)
 
-    items = session.query(Item).filter_by(category=category).all()
+    items = queries.category_items(session, category_id).all()
     can_edit = g.logged_in and category.user_id == g.user_id
 
     return render_template("show_category.html", category=category,
@@ -205,7 +751,8 @@ def edit_category(category_id):
     id of a given category.
     """
     try:
-        category = session.query(Category).filter_by(id=category_id).one()
+        category = queries.live_categories(session) \
+            .filter_by(id=category_id).one()
     except:
         return abort(404)
 
@@ -218,7 +765,11 @@ def edit_category(category_id):
     elif request.method == "POST":
         category.name = request.form["name"]
         session.add(category)
+        touch(Category, [category.id])
         session.commit()
+
+        # Item pages show the name of their category
+        evict_pages(category_ids=[category.id], item_pages_of=[category.id])
         flash("Category \"%s\" edited" % category.name)
         return redirect(url_for("index"))
 
@@ -231,7 +782,8 @@ def delete_category(category_id):
     and matches the user id of a given category.
     """
     try:
-        category = session.query(Category).filter_by(id=category_id).one()
+        category = queries.live_categories(session) \
+            .filter_by(id=category_id).one()
     except:
         return abort(404)
 
@@ -244,9 +796,18 @@ def delete_category(category_id):
 
     elif request.method == "POST":
         category_name = category.name
-        session.query(Item).filter_by(category_id=category.id).delete()
-        session.query(Category).filter_by(id=category.id).delete()
+        if category.item_count < SOFT_DELETE_MIN_ITEMS:
+            # ON DELETE CASCADE deletes the items in the same statement
+            session.query(Category).filter_by(id=category.id).delete()
+        else:
+            # Deleting every item at once would hold the database's write
+            # lock for long, so the category is only hidden here and purged
+            # in batches by worker.py
+            session.query(Category).filter_by(id=category.id).update(
+                {Category.deleted_at: int_time()}, synchronize_session=False)
+            enqueue(session, "purge_category", category_id)
         session.commit()
+        evict_pages(category_ids=[category_id], item_pages_of=[category_id])
         flash("Category \"%s\" deleted" % category_name)
         return redirect(url_for("index"))
 
@@ -257,7 +818,7 @@ def create_item():
     """ Creates an item for a given in a given category user if logged in """
 
     if request.method == "GET":
-        categories = session.query(Category).all()
+        categories = queries.live_categories(session).all()
 
         return render_template("create_item.html", categories=categories)
 
@@ -265,30 +826,54 @@ def create_item():
         name = request.form["name"]
         description = request.form["description"]
         category_id = int(request.form["category"])
+        if not is_live_category(category_id):
+            return abort(400)
 
         new_item = Item(name=name, description=description,
                         category_id=category_id, timestamp=int_time(),
                         user_id=cookie_session["user_id"])
         session.add(new_item)
+        touch(Category, [category_id])
+        update_item_stats(category_id, 1)
         session.commit()
+        evict_pages(category_ids=[category_id])
         flash("Item \"%s\" created" % name)
         return redirect(url_for("index"))
 
 
 @app.route("/item/<int:item_id>")
+@query_budget(1)
+@cached_page("item:%(item_id)d")
 def show_item(item_id):
     """
     Shows an item with its information. Options for editing and deleting are
     shown if the user is logged in and matches the user id of a given category.
     """
     try:
-        item = session.query(Item).filter_by(id=item_id).one()
+        item = queries.item_by_id(session, item_id).one()
     except:
         return abort(404)
 
+    # The page is cached until its category is renamed or deleted
+    depend_on_generation("generation:category:%d" % item.category_id)
+
+    # The page also shows the category name and depends on who is viewing it
+    etag = "item-page-%d-%d-%d-%d-%s" % (item.id, item.version, item.timestamp,
+                                         item.category.version, g.user_id)
+    last_modified = max(item.timestamp, item.category.timestamp)
+    cached = not_modified(etag, last_modified)
+    if cached is not None:
+        return cached
+
     can_edit = g.logged_in and (item.user_id == g.user_id)
 
-    return render_template("show_item.html", item=item, can_edit=can_edit)
+    # Pages showing a flash message must not be cached
+    has_flashes = "_flashes" in cookie_session
+    response = make_response(render_template("show_item.html", item=item,
+                                             can_edit=can_edit))
+    if has_flashes:
+        return response
+    return add_validators(response, etag, last_modified)
 
 
 @app.route("/item/<int:item_id>/edit", methods=["GET", "POST"])
@@ -299,7 +884,7 @@ def edit_item(item_id):
     and matches the user id of a given category.
     """
     try:
-        item = session.query(Item).filter_by(id=item_id).one()
+        item = queries.live_items(session).filter(Item.id == item_id).one()
     except:
         return abort(404)
 
@@ -309,18 +894,33 @@ def edit_item(item_id):
     if request.method == "GET":
         # PEP8 complains about E712 here but that cannot be avoided due to
         # the overloaded != operator
-        categories = session.query(Category).all()
+        categories = queries.live_categories(session).all()
 
         return render_template("edit_item.html", categories=categories,
                                item=item)
 
     elif request.method == "POST":
+        category_id = int(request.form["category"])
+        if not is_live_category(category_id):
+            return abort(400)
+
+        old_category_id = item.category_id
         item.name = request.form["name"]
         item.description = request.form["description"]
-        item.category_id = int(request.form["category"])
+        item.category_id = category_id
 
         session.add(item)
+        touch(Item, [item.id])
+        touch(Category, set([old_category_id, item.category_id]))
+        if item.category_id == old_category_id:
+            update_item_stats(item.category_id, 0)
+        else:
+            session.flush()
+            update_item_stats(old_category_id, -1)
+            update_item_stats(item.category_id, 1)
         session.commit()
+        evict_pages(category_ids=set([old_category_id, item.category_id]),
+                    item_ids=[item_id])
         flash("Item \"%s\" edited" % item.name)
         return redirect(url_for("show_item", item_id=item.id))
 
@@ -333,7 +933,7 @@ def delete_item(item_id):
     and matches the user id of a given category.
     """
     try:
-        item = session.query(Item).filter_by(id=item_id).one()
+        item = queries.live_items(session).filter(Item.id == item_id).one()
     except:
         return abort(404)
 
@@ -345,12 +945,45 @@ def delete_item(item_id):
 
     elif request.method == "POST":
         item_name = item.name
+        category_id = item.category_id
         session.query(Item).filter_by(id=item_id).delete()
+        touch(Category, [category_id])
+        update_item_stats(category_id, -1)
         session.commit()
+        evict_pages(category_ids=[category_id], item_ids=[item_id])
         flash("Item \"%s\" deleted" % item_name)
         return redirect(url_for("index"))
 
 
+@app.route("/avatar/<int:user_id>")
+def avatar(user_id):
+    """
+    Serves a user's cached picture at the smallest cached size no smaller
+    than the size argument. Pictures not cached yet, or missing from this
+    server's disk, redirect to the original.
+    """
+    user = session.query(User.avatar, User.picture).filter_by(
+        id=user_id).first()
+    if user is None or (user.avatar is None and not user.picture):
+        return abort(404)
+    if user.avatar is None:
+        return redirect(user.picture)
+
+    size = request.args.get("size", avatars.SIZES[0], type=int)
+    size = min([s for s in avatars.SIZES if s >= size] or
+               [max(avatars.SIZES)])
+    path = avatars.store.path(user.avatar, size)
+    if not os.path.exists(path):
+        if not user.picture:
+            return abort(404)
+        return redirect(user.picture)
+    versioned = request.args.get("v") == user.avatar
+    return send_file(path,
+                     mimetype="image/jpeg", conditional=True,
+                     cache_timeout=AVATAR_VERSIONED_MAX_AGE if versioned
+                     else AVATAR_MAX_AGE)
+
+
 @app.route("/login")
 def login():
     """ Sets a state and presents Google and Facebook login options """
@@ -358,9 +991,11 @@ def login():
                     for x in xrange(32))
 
     cookie_session["state"] = state
+    google_app = read_client_secrets("google_client_secrets.json")
+    facebook_app = read_client_secrets("facebook_client_secrets.json")
     return render_template("login.html", state=state,
-                           google_client_id=GOOGLE_CLIENT_ID,
-                           facebook_app_id=FACEBOOK_APP_DATA["web"]["app_id"])
+                           google_client_id=google_app["client_id"],
+                           facebook_app_id=facebook_app["app_id"])
 
 
 @app.route("/auth/gconnect", methods=["POST"])
@@ -382,8 +1017,10 @@ def google_login():
 
     access_token = credentials.access_token
 
-    result = requests.get("https://www.googleapis.com/oauth2/v1/tokeninfo",
-                          params=dict(access_token=access_token)).json()
+    try:
+        result = google.token_info(access_token)
+    except ProviderError:
+        return error_response("Failed to contact Google", 502)
 
     if result.get("error") is not None:
         return error_response(result["error"], 500)
@@ -394,7 +1031,8 @@ def google_login():
     if result["user_id"] != gplus_id:
         return error_response("Token\"s user ID does not match given ID", 401)
 
-    if result["issued_to"] != GOOGLE_CLIENT_ID:
+    google_app = read_client_secrets("google_client_secrets.json")
+    if result["issued_to"] != google_app["client_id"]:
         return error_response("Token\"s client ID does not match app\"s", 401)
 
     stored_access_token = cookie_session.get("access_token")
@@ -402,17 +1040,19 @@ def google_login():
     if stored_access_token is not None and gplus_id == stored_gplus_id:
         return jsonify({"message": "Already connected"})
 
-    # Store access_token and gplus_id in session cookie
+    # Store access_token and gplus_id in the session, under a new id
+    cookie_session.rotate()
     cookie_session["access_token"] = access_token
     cookie_session["gplus_id"] = gplus_id
 
     # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {"access_token": access_token, "alt": "json"}
-    data = requests.get(userinfo_url, params=params).json()
+    try:
+        data = google.user_info(access_token)
+    except ProviderError:
+        return error_response("Failed to contact Google", 502)
 
-    # Only store what is needed to identify the user to avoid excessively
-    # long cookies. The rest is stored in a database
+    # Only store what is needed to identify the user. The rest is stored in
+    # the user table
     cookie_session["email"] = data["email"]
     cookie_session["provider"] = "google"
 
@@ -422,6 +1062,7 @@ def google_login():
         user_id = create_user(data["email"], data["name"], data["picture"]).id
     else:
         user_id = user.id
+    cache_avatar(user_id)
 
     cookie_session["user_id"] = user_id
 
@@ -438,21 +1079,17 @@ def facebook_login():
         return error_response("Invalid state parameter", 401)
 
     access_token = request.data
-    app_id = FACEBOOK_APP_DATA["web"]["app_id"]
-    app_secret = FACEBOOK_APP_DATA["web"]["app_secret"]
+    facebook_app = read_client_secrets("facebook_client_secrets.json")
+    app_id = facebook_app["app_id"]
+    app_secret = facebook_app["app_secret"]
 
-    result = requests.get("https://graph.facebook.com/oauth/access_token",
-                          params=dict(grant_type="fb_exchange_token",
-                                      client_id=app_id,
-                                      client_secret=app_secret,
-                                      fb_exchange_token=access_token)).text
-
-    token = parse_query_string(result)["access_token"]
-
-    data = requests.get("https://graph.facebook.com/v2.5/me?",
-                        params=dict(access_token=token,
-                                    fields="name,id,email")).json()
+    try:
+        token = facebook.exchange_token(app_id, app_secret, access_token)
+        data, picture = facebook.profile(token)
+    except ProviderError:
+        return error_response("Failed to contact Facebook", 502)
 
+    cookie_session.rotate()
     cookie_session["provider"] = "facebook"
 
     username = data["name"]
@@ -461,19 +1098,12 @@ def facebook_login():
     cookie_session["facebook_id"] = data["id"]
     cookie_session["access_token"] = token
 
-    url = ("https://graph.facebook.com/v2.5/me/picture?%s&redirect=0"
-           "&height=200&width=200") % token
-    data = requests.get("https://graph.facebook.com/v2.5/me/picture",
-                        params=dict(redirect=0, height=200, width=200,
-                                    access_token=token)).json()
-
-    picture = data["data"]["url"]
-
     # see if user exists
     user = get_user_by_email(email)
 
     if not user:
         user = create_user(email, username, picture)
+    cache_avatar(user.id)
 
     cookie_session["user_id"] = user.id
     cookie_session["email"] = email
@@ -492,14 +1122,9 @@ def google_logout():
     del cookie_session["gplus_id"]
     del cookie_session["access_token"]
 
-    result = requests.get("https://accounts.google.com/o/oauth2/revoke",
-                          params=dict(token=access_token))
-
-    # Invalid token should be ignored since that usually means the user is
-    # already logged out
-    if result.status_code != 200 \
-            and json.loads(result[1])["error"] != "invalid_token":
-        return error_response("Failed to revoke token for user", 400)
+    # Revoked by worker.py, which retries on failure
+    enqueue(session, "revoke_google_token", access_token)
+    session.commit()
 
 
 def facebook_logout():
@@ -507,8 +1132,8 @@ def facebook_logout():
     facebook_id = cookie_session.get("facebook_id")
     access_token = cookie_session.get("access_token")
 
-    requests.delete("https://graph.facebook.com/%s/permissions" % facebook_id,
-                    params=dict(access_token=access_token))
+    enqueue(session, "revoke_facebook_token", facebook_id, access_token)
+    session.commit()
 
 
 @app.route("/logout")
@@ -519,11 +1144,7 @@ def logout():
     """
     if "provider" in cookie_session:
         if cookie_session["provider"] == "google":
-            logout_result = google_logout()
-
-            # Return the error for debugging
-            if logout_result is not None:
-                return logout_result
+            google_logout()
 
         elif cookie_session["provider"] == "facebook":
             facebook_logout()
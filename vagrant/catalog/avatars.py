@@ -0,0 +1,115 @@
+"""
+A local cache of user pictures
+
+Pictures are downloaded once by worker.py after a login, then resized to
+thumbnails of every size in SIZES and stored on disk under the SHA-1 of the
+downloaded image, e.g. avatars/3f/3f2a...-48.jpg. Users with the same
+picture share the files, and a changed picture gets new ones.
+
+The app serves them at /avatar/<user_id> without depending on the
+providers' servers. Resizing needs Pillow. Without it nothing is cached,
+and the app redirects to the original picture instead.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+
+import requests
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Relative to the app, like the template cache, so that the worker and the
+# app share it whatever directory they are started from
+AVATAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.environ.get("CATALOG_AVATAR_DIR", "avatars"))
+
+# Thumbnail widths and heights, in pixels
+SIZES = (48, 200)
+
+# Larger downloads are abandoned
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+class AvatarError(Exception):
+
+    """ Raised when a picture cannot be downloaded or read """
+
+    pass
+
+
+def available():
+    """ Whether thumbnails can be made, i.e. Pillow is installed """
+    return Image is not None
+
+
+def download(url, timeout=10.0):
+    """ Returns the bytes of the image at url """
+    try:
+        response = requests.get(url, timeout=timeout, stream=True)
+        if response.status_code != 200 or not response.headers.get(
+                "Content-Type", "").startswith("image/"):
+            raise AvatarError("No image at %s" % url)
+
+        data = io.BytesIO()
+        for chunk in response.iter_content(64 * 1024):
+            data.write(chunk)
+            if data.tell() > MAX_IMAGE_BYTES:
+                raise AvatarError("Image at %s is too large" % url)
+        return data.getvalue()
+    except requests.RequestException as e:
+        raise AvatarError(str(e))
+
+
+def thumbnail(data, size):
+    """ Returns data cropped to a square and resized as a JPEG """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.fit(image.convert("RGB"), (size, size),
+                             Image.ANTIALIAS)
+    except (IOError, ValueError) as e:
+        raise AvatarError("Unreadable image: %s" % e)
+
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+
+class AvatarStore(object):
+
+    """ Thumbnails on disk under directory, named by their source's hash """
+
+    def __init__(self, directory=AVATAR_DIR):
+        self.directory = os.path.abspath(directory)
+
+    def path(self, digest, size):
+        return os.path.join(self.directory, digest[:2],
+                            "%s-%d.jpg" % (digest, size))
+
+    def save(self, data):
+        """
+        Stores the thumbnails of an image, unless already stored, and
+        returns the image's digest
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        for size in SIZES:
+            path = self.path(digest, size)
+            if os.path.exists(path):
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            # Written under a temporary name and renamed, so the app never
+            # serves a partly written file
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(thumbnail(data, size))
+            os.rename(temporary, path)
+        return digest
+
+
+store = AvatarStore()
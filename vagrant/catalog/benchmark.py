@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Load tests for the catalog's read routes
+
+Seeds a database with synthetic users, categories and items, then requests
+the home page, category and item pages and their JSON APIs, both through
+the Flask test client and over HTTP against a multi-threaded server. Each
+route is requested anonymously and as a logged in user, whose login is
+injected into a stored session instead of going through OAuth.
+
+Latency percentiles and requests per second are printed for every route,
+along with the change from the previous run, and each run is appended to a
+JSON results file to compare runs across commits.
+
+Usage:
+  python benchmark.py [--categories 100] [--items 100] [--users 10]
+                      [--requests 500] [--threads 8] [--mode both]
+                      [--database sqlite:///benchmark.db]
+                      [--output benchmark-results.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import app
+from bulk import import_rows
+from category_stats import repair_category_stats
+from database_setup import Base, User, Category, Item, create_db_engine
+from search import rebuild_search_index, supports_search_index
+
+# Route name and a function of (random, categories, items) returning a path
+ROUTES = [
+    ("index", lambda r, c, i: "/"),
+    ("show_category", lambda r, c, i: "/category/%d" % r.randint(1, c)),
+    ("show_item", lambda r, c, i: "/item/%d" % r.randint(1, i)),
+    ("catalog_json", lambda r, c, i: "/api/categories.json"),
+    ("category_json",
+     lambda r, c, i: "/api/category/%d.json" % r.randint(1, c)),
+    ("item_json", lambda r, c, i: "/api/item/%d.json" % r.randint(1, i)),
+]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    """ Skips logging each request, which would dominate the output """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def seed(engine, categories, items_per_category, users):
+    """ Recreates the schema and fills it with synthetic rows """
+    # The search index is not part of the metadata, so is dropped by hand
+    # for create_all() to recreate it along with its triggers
+    engine.execute("DROP TABLE IF EXISTS item_search")
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    import_rows(engine, User.__table__,
+                (dict(id=u + 1, name="User %d" % u,
+                      email="user%d@example.com" % u)
+                 for u in range(users)))
+    import_rows(engine, Category.__table__,
+                (dict(id=c + 1, name="Category %d" % c, timestamp=0,
+                      user_id=c % users + 1)
+                 for c in range(categories)))
+    import_rows(engine, Item.__table__,
+                (dict(id=n + 1, name="Item %d" % n,
+                      description="Description of item %d" % n,
+                      timestamp=n, category_id=n % categories + 1,
+                      user_id=n % users + 1)
+                 for n in range(categories * items_per_category)))
+
+    with engine.begin() as connection:
+        repair_category_stats(connection)
+        if supports_search_index(connection):
+            rebuild_search_index(connection)
+
+
+def login_cookie(user_id):
+    """ Returns a session cookie value logging the client in as user_id """
+    return app.app.session_interface.create(
+        app.app, dict(email="user%d@example.com" % (user_id - 1),
+                      user_id=user_id, provider="benchmark"))
+
+
+def percentile(latencies, p):
+    """ Returns the p-th percentile of sorted latencies by nearest rank """
+    if not latencies:
+        return None
+    index = max(int(round(p / 100.0 * len(latencies))) - 1, 0)
+    return latencies[index]
+
+
+def summarize(mode, route, user, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return dict(mode=mode, route=route, user=user,
+                requests=len(latencies) + errors, errors=errors,
+                p50_ms=percentile(latencies, 50),
+                p95_ms=percentile(latencies, 95),
+                p99_ms=percentile(latencies, 99),
+                rps=(len(latencies) + errors) / max(elapsed, 1e-6))
+
+
+def run_client(paths, cookie):
+    """ Requests paths through the test client, returns latencies in ms """
+    client = app.app.test_client()
+    if cookie is not None:
+        client.set_cookie("localhost", app.app.session_cookie_name, cookie)
+
+    latencies = []
+    errors = 0
+    for path in paths:
+        started = time.time()
+        response = client.get(path)
+        response.get_data()
+        if response.status_code == 200:
+            latencies.append((time.time() - started) * 1000)
+        else:
+            errors += 1
+    return latencies, errors
+
+
+def run_server(url, paths, cookie, threads):
+    """
+    Requests paths from a server with a pool of client threads, each with its
+    own keep-alive connection. Returns latencies in ms and the error count.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = iter(paths)
+
+    def client():
+        http = requests.Session()
+        if cookie is not None:
+            http.cookies.set(app.app.session_cookie_name, cookie)
+        while True:
+            with lock:
+                path = next(remaining, None)
+            if path is None:
+                return
+            started = time.time()
+            try:
+                ok = http.get(url + path).status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append((time.time() - started) * 1000)
+                else:
+                    errors[0] += 1
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors[0]
+
+
+def benchmark(engine, categories, items, requests_per_route=500, threads=8,
+              modes=("client", "server"), user_id=1):
+    """ Runs every route in every mode and returns a list of results """
+    # The app's engine is put back afterwards, like the rate limits below
+    bind = app.session.session_factory.kw.get("bind")
+    app.session.remove()
+    app.session.configure(bind=engine)
+    app.app.secret_key = app.app.secret_key or "benchmark"
+    cookie = login_cookie(user_id)
+
+    # Every request comes from one client, which the rate limits would stop.
+    # They are put back afterwards, for whatever else runs in this process
+    limiters = dict(app.rate_limiters)
+    app.rate_limiters.clear()
+    server = None
+    results = []
+    try:
+        if "server" in modes:
+            server = make_server("127.0.0.1", 0, app.app, threaded=True,
+                                 request_handler=QuietRequestHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            url = "http://127.0.0.1:%d" % server.server_port
+
+        for mode in modes:
+            for route, make_path in ROUTES:
+                for user, user_cookie in (("anonymous", None),
+                                          ("logged_in", cookie)):
+                    r = random.Random(route)
+                    paths = [make_path(r, categories, items)
+                             for _ in range(requests_per_route)]
+                    app.page_cache.clear()
+                    started = time.time()
+                    if mode == "client":
+                        latencies, errors = run_client(paths, user_cookie)
+                    else:
+                        latencies, errors = run_server(url, paths,
+                                                       user_cookie, threads)
+                    results.append(summarize(mode, route, user, latencies,
+                                             errors, time.time() - started))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        app.rate_limiters.update(limiters)
+        app.session.remove()
+        app.session.configure(bind=bind)
+    return results
+
+
+def git_commit():
+    """ Returns the current commit hash, or None outside of a git checkout """
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_runs(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_results(results, previous=None):
+    """ Prints a table of results, with changes from a previous run """
+    before = {}
+    if previous is not None:
+        before = dict(((r["mode"], r["route"], r["user"]), r)
+                      for r in previous["results"])
+
+    print("%-7s %-14s %-10s %8s %8s %8s %9s %7s" %
+          ("mode", "route", "user", "p50 ms", "p95 ms", "p99 ms", "req/s",
+           "errors"))
+    for r in results:
+        line = "%-7s %-14s %-10s %8.2f %8.2f %8.2f %9.1f %7d" % (
+            r["mode"], r["route"], r["user"], r["p50_ms"] or 0,
+            r["p95_ms"] or 0, r["p99_ms"] or 0, r["rps"], r["errors"])
+        old = before.get((r["mode"], r["route"], r["user"]))
+        if old is not None and old["rps"]:
+            line += "  (%+.0f%% req/s)" % ((r["rps"] / old["rps"] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load tests the catalog's read routes")
+    parser.add_argument("--categories", type=int, default=100)
+    parser.add_argument("--items", type=int, default=100,
+                        help="items per category")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per route, mode and user")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="client threads against the server")
+    parser.add_argument("--mode", choices=["client", "server", "both"],
+                        default="both")
+    parser.add_argument("--database", default="sqlite:///benchmark.db")
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    seed(engine, args.categories, args.items, args.users)
+
+    modes = ("client", "server") if args.mode == "both" else (args.mode,)
+    results = benchmark(engine, args.categories,
+                        args.categories * args.items, args.requests,
+                        args.threads, modes)
+
+    runs = load_runs(args.output)
+    print_results(results, runs[-1] if runs else None)
+    runs.append(dict(commit=git_commit(), time=int(time.time()),
+                     config=dict(categories=args.categories,
+                                 items=args.items, users=args.users,
+                                 requests=args.requests,
+                                 threads=args.threads),
+                     results=results))
+    with open(args.output, "w") as f:
+        json.dump(runs, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
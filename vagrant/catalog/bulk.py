@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Bulk import and export of catalog data as CSV or newline-delimited JSON
+
+Imports insert rows in batches with an executemany per batch and set of
+columns, each batch in its own transaction, which is orders of magnitude
+faster than adding items one at a time through the web app. Exports stream
+rows from the database in batches so memory use does not grow with the
+catalog.
+
+Both print their progress and speed to stderr. Importing items also
+recomputes the item counts of every category afterwards. Rows are read and
+written with the column names of the table, e.g. id, name, description,
+timestamp, category_id and user_id for items. Columns missing from an import
+take their database defaults.
+
+Usage:
+  python bulk.py import items items.csv [--batch-size 5000]
+  python bulk.py export items items.ndjson
+  python bulk.py export categories - --format csv
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+from sqlalchemy import Integer, select
+
+from database_setup import DATABASE_URL, User, Category, Item, create_db_engine
+from category_stats import repair_category_stats
+
+TABLES = {
+    "users": User.__table__,
+    "categories": Category.__table__,
+    "items": Item.__table__,
+}
+
+
+def batches(rows, size):
+    """ Splits an iterable of rows into lists of at most size rows """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def groups(rows):
+    """
+    Splits a list of dicts into lists of dicts with the same keys, in the
+    order each set of keys first appears, so that each can be inserted with
+    one executemany
+    """
+    grouped = {}
+    order = []
+    for row in rows:
+        keys = frozenset(row)
+        if keys not in grouped:
+            grouped[keys] = []
+            order.append(keys)
+        grouped[keys].append(row)
+    return [grouped[keys] for keys in order]
+
+
+class Progress(object):
+
+    """ Reports a running row count and rate to stderr """
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.rows = 0
+        self.started = time.time()
+
+    def add(self, rows):
+        self.rows += rows
+        sys.stderr.write("\r%s %d rows (%.0f rows/s)" %
+                         (self.verb, self.rows, self.rate()))
+
+    def rate(self):
+        return self.rows / max(time.time() - self.started, 1e-6)
+
+    def finish(self):
+        sys.stderr.write("\r%s %d rows in %.1fs (%.0f rows/s)\n" %
+                         (self.verb, self.rows, time.time() - self.started,
+                          self.rate()))
+
+
+def read_rows(f, fmt):
+    """
+    Yields the rows of a CSV or NDJSON file as dicts. Fields missing from a
+    short CSV row are left out, and extra fields of a long one ignored.
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(f):
+            yield dict((key, value.decode("utf-8"))
+                       for key, value in row.items()
+                       if key is not None and value is not None)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def convert(column, value):
+    """
+    Converts a value read from a file to the type of column. CSV has no null,
+    so an empty integer field is read as null.
+    """
+    if not isinstance(column.type, Integer):
+        return value
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def import_rows(engine, table, rows, batch_size=5000, progress=None):
+    """
+    Inserts rows, an iterable of dicts, into table in batches of batch_size.
+    Keys that are not columns of the table are ignored, and columns missing
+    from a row take their defaults: rows of a batch are inserted in groups
+    with the same columns. Returns the number of rows inserted.
+    """
+    def normalize(row):
+        return dict((key, convert(table.c[key], value))
+                    for key, value in row.items() if key in table.c)
+
+    inserted = 0
+    connection = engine.connect()
+    try:
+        for batch in batches((normalize(row) for row in rows), batch_size):
+            with connection.begin():
+                for group in groups(batch):
+                    connection.execute(table.insert(), group)
+            inserted += len(batch)
+            if progress is not None:
+                progress.add(len(batch))
+    finally:
+        connection.close()
+
+    return inserted
+
+
+def export_rows(engine, table, batch_size=5000):
+    """
+    Yields every row of table as a dict, in order of id. Rows are fetched
+    batch_size at a time through a server-side cursor where supported.
+    """
+    connection = engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(
+            select([table]).order_by(table.c.id))
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                yield dict(row)
+    finally:
+        connection.close()
+
+
+def write_rows(f, fmt, table, rows, progress=None):
+    """ Writes dicts to a CSV or NDJSON file """
+    if fmt == "csv":
+        writer = csv.DictWriter(f, [column.name for column in table.c])
+        writer.writeheader()
+
+    written = 0
+    for row in rows:
+        if fmt == "csv":
+            writer.writerow(dict(
+                (key, value.encode("utf-8") if isinstance(value, unicode)
+                 else value)
+                for key, value in row.items()))
+        else:
+            f.write(json.dumps(row) + "\n")
+
+        written += 1
+        if progress is not None and written % 1000 == 0:
+            progress.add(1000)
+
+    if progress is not None:
+        progress.add(written % 1000)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk import and export of catalog data")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("table", choices=sorted(TABLES))
+    parser.add_argument("path", help="file to read or write, - for stdio")
+    parser.add_argument("--format", choices=["csv", "ndjson"],
+                        help="defaults to the extension of path, else ndjson")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--database", default=DATABASE_URL)
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    table = TABLES[args.table]
+    engine = create_db_engine(args.database)
+
+    if args.command == "import":
+        f = sys.stdin if args.path == "-" else open(args.path, "rb")
+        progress = Progress("Imported")
+        import_rows(engine, table, read_rows(f, fmt), args.batch_size,
+                    progress)
+        if table is Item.__table__:
+            with engine.begin() as connection:
+                repair_category_stats(connection)
+    else:
+        f = sys.stdout if args.path == "-" else open(args.path, "wb")
+        progress = Progress("Exported")
+        write_rows(f, fmt, table, export_rows(engine, table, args.batch_size),
+                   progress)
+
+    if args.path != "-":
+        f.close()
+    progress.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Caches shared by the catalog views
+
+Two interchangeable backends are provided. LRUCache lives inside a single
+process, while MemcachedCache talks to a memcached server (or the stand-in in
+cache_server.py) so that every worker shares one cache and an eviction made by
+one worker is seen by all of them. Both hold entries for a fixed time to live.
+
+Backends have the same methods: get, set, delete, clear and stats. Use
+create_cache() to build one from a URL.
+"""
+
+import pickle
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    """
+    A thread-safe least recently used cache with a time to live
+
+    Once max_entries is reached, setting a new key evicts the entry that was
+    used least recently. Entries older than ttl seconds are treated as missing,
+    and a ttl of None keeps entries until they are evicted.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, value = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # Re-insert to mark the entry as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Stores value under key, evicting old entries once it is full """
+        with self.lock:
+            self.entries.pop(key, None)
+            expires = float("inf") if self.ttl is None else \
+                time.time() + self.ttl
+            self.entries[key] = (expires, value)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        """ Removes the given keys, ignoring any that are not cached """
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ Returns the current size and hit/miss/eviction counters """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class MemcachedCache(object):
+
+    """
+    A client for the memcached text protocol
+
+    Values are pickled, so the server must only be reachable by trusted
+    workers. Keys are prefixed with prefix so several caches can share one
+    server. Each thread keeps its own connection. Network errors are counted
+    and treated as cache misses so an unavailable server never breaks a page.
+    """
+
+    def __init__(self, host="127.0.0.1", port=11211, ttl=300, prefix="",
+                 timeout=1.0):
+        self.address = (host, port)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def connection(self):
+        """ Returns this thread's (socket, file) pair, connecting if needed """
+        if getattr(self.local, "connection", None) is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            self.local.connection = (sock, sock.makefile("rb"))
+        return self.local.connection
+
+    def disconnect(self):
+        """ Drops this thread's connection after an error """
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        try:
+            sock, f = self.connection()
+            sock.sendall("get %s%s\r\n" % (self.prefix, key))
+
+            value = None
+            line = f.readline()
+            while line.startswith("VALUE "):
+                size = int(line.split()[3])
+                value = pickle.loads(f.read(size + 2)[:-2])
+                line = f.readline()
+            if line != "END\r\n":
+                raise IOError("Unexpected response: %r" % line)
+        except (IOError, socket.error):
+            self.disconnect()
+            self.count("errors")
+            value = None
+
+        self.count("misses" if value is None else "hits")
+        return value
+
+    def set(self, key, value):
+        """ Stores value under key """
+        data = pickle.dumps(value, 2)
+        try:
+            sock, f = self.connection()
+            sock.sendall("set %s%s 0 %d %d\r\n%s\r\n" %
+                         (self.prefix, key, self.ttl, len(data), data))
+            line = f.readline()
+            if line != "STORED\r\n":
+                raise IOError("Unexpected response: %r" % line)
+        except (IOError, socket.error):
+            self.disconnect()
+            self.count("errors")
+
+    def incr(self, key, delta=1):
+        """
+        Atomically adds delta to the counter under key, creating it if it is
+        missing, and returns the new value, or None after a network error.
+        Counters are stored as plain numbers rather than pickled, so read one
+        with incr(key, 0) instead of get(). They expire ttl seconds after
+        being created.
+        """
+        key = self.prefix + key
+        try:
+            sock, f = self.connection()
+            sock.sendall("incr %s %d\r\n" % (key, delta))
+            line = f.readline()
+            if line == "NOT_FOUND\r\n":
+                if not delta:
+                    return 0
+                sock.sendall("add %s 0 %d %d\r\n%d\r\n" %
+                             (key, self.ttl, len(str(delta)), delta))
+                line = f.readline()
+                if line == "STORED\r\n":
+                    return delta
+                if line != "NOT_STORED\r\n":
+                    raise IOError("Unexpected response: %r" % line)
+                # Another client created the counter in the meantime
+                sock.sendall("incr %s %d\r\n" % (key, delta))
+                line = f.readline()
+            if not line[:-2].isdigit():
+                raise IOError("Unexpected response: %r" % line)
+            return int(line)
+        except (IOError, socket.error):
+            self.disconnect()
+            self.count("errors")
+            return None
+
+    def delete(self, *keys):
+        """
+        Removes the given keys. The commands are pipelined and their replies
+        read together, so evicting many keys costs a single round trip, and
+        the keys are gone from the server by the time this returns.
+        """
+        if not keys:
+            return
+        try:
+            sock, f = self.connection()
+            commands = ["delete %s%s\r\n" % (self.prefix, key)
+                        for key in keys]
+            sock.sendall("".join(commands))
+            for key in keys:
+                line = f.readline()
+                if line not in ("DELETED\r\n", "NOT_FOUND\r\n"):
+                    raise IOError("Unexpected response: %r" % line)
+        except (IOError, socket.error):
+            self.disconnect()
+            self.count("errors")
+
+    def clear(self):
+        """ Removes every entry on the server, including other prefixes """
+        try:
+            sock, f = self.connection()
+            sock.sendall("flush_all\r\n")
+            f.readline()
+        except (IOError, socket.error):
+            self.disconnect()
+            self.count("errors")
+
+    def stats(self):
+        """ Returns this client's hit/miss/error counters """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+            }
+
+
+def create_cache(url, max_entries=1000, ttl=300, prefix=""):
+    """
+    Builds a cache from a URL. "memory://" gives an LRUCache private to this
+    process and "memcached://host:port" a MemcachedCache shared by every
+    worker using the same server.
+    """
+    if url == "memory://":
+        return LRUCache(max_entries=max_entries, ttl=ttl)
+
+    if url.startswith("memcached://"):
+        host, _, port = url[len("memcached://"):].partition(":")
+        return MemcachedCache(host=host or "127.0.0.1",
+                              port=int(port or 11211), ttl=ttl, prefix=prefix)
+
+    raise ValueError("Unsupported cache URL: %s" % url)
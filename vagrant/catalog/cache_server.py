@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+A small stand-in for memcached, for development and tests
+
+Implements the subset of the memcached text protocol used by
+cache.MemcachedCache: get, set, add, incr, delete (including noreply),
+flush_all, stats and quit. Entries are kept in memory, least recently used
+first out once max_entries is reached.
+
+Usage: python cache_server.py [port]
+"""
+
+import SocketServer
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+# memcached treats expiry times above 30 days as absolute Unix timestamps
+RELATIVE_EXPIRY_LIMIT = 60 * 60 * 24 * 30
+
+
+class CacheStore(object):
+
+    """ The entries held by the server, safe to use from many threads """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"get_hits": 0, "get_misses": 0, "evictions": 0}
+
+    def get(self, key):
+        """ Returns (flags, data) for key, or None """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or 0 < entry[0] < time.time():
+                self.counters["get_misses"] += 1
+                return None
+
+            self.entries[key] = entry
+            self.counters["get_hits"] += 1
+            return entry[1], entry[2]
+
+    def set(self, key, flags, exptime, data):
+        if exptime == 0:
+            expires = 0
+        elif exptime <= RELATIVE_EXPIRY_LIMIT:
+            expires = time.time() + exptime
+        else:
+            expires = exptime
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, flags, data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def add(self, key, flags, exptime, data):
+        """ Sets key unless present, returning whether it was set """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not 0 < entry[0] < time.time():
+                return False
+            self.entries.pop(key, None)
+        self.set(key, flags, exptime, data)
+        return True
+
+    def incr(self, key, delta):
+        """ Adds delta to the number under key, or returns None if missing """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or 0 < entry[0] < time.time():
+                return None
+            expires, flags, data = entry
+            value = int(data) + delta
+            self.entries[key] = (expires, flags, str(value))
+            return value
+
+    def delete(self, key):
+        """ Removes key, returning whether it was present """
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["curr_items"] = len(self.entries)
+            return stats
+
+
+class CacheRequestHandler(SocketServer.StreamRequestHandler):
+
+    """ Serves memcached text protocol commands from one client """
+
+    def handle(self):
+        store = self.server.store
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+
+            if command in ("get", "gets"):
+                for key in parts[1:]:
+                    entry = store.get(key)
+                    if entry is not None:
+                        flags, data = entry
+                        self.wfile.write("VALUE %s %d %d\r\n%s\r\n" %
+                                         (key, flags, len(data), data))
+                self.wfile.write("END\r\n")
+
+            elif command == "set" and len(parts) >= 5:
+                key, flags, exptime, size = parts[1:5]
+                data = self.rfile.read(int(size) + 2)[:-2]
+                store.set(key, int(flags), int(exptime), data)
+                if parts[-1] != "noreply":
+                    self.wfile.write("STORED\r\n")
+
+            elif command == "add" and len(parts) >= 5:
+                key, flags, exptime, size = parts[1:5]
+                data = self.rfile.read(int(size) + 2)[:-2]
+                added = store.add(key, int(flags), int(exptime), data)
+                if parts[-1] != "noreply":
+                    self.wfile.write("STORED\r\n" if added
+                                     else "NOT_STORED\r\n")
+
+            elif command == "incr" and len(parts) >= 3:
+                value = store.incr(parts[1], int(parts[2]))
+                if parts[-1] != "noreply":
+                    self.wfile.write("NOT_FOUND\r\n" if value is None
+                                     else "%d\r\n" % value)
+
+            elif command == "delete" and len(parts) >= 2:
+                deleted = store.delete(parts[1])
+                if parts[-1] != "noreply":
+                    self.wfile.write("DELETED\r\n" if deleted
+                                     else "NOT_FOUND\r\n")
+
+            elif command == "flush_all":
+                store.clear()
+                if parts[-1] != "noreply":
+                    self.wfile.write("OK\r\n")
+
+            elif command == "stats":
+                for name, value in sorted(store.stats().items()):
+                    self.wfile.write("STAT %s %d\r\n" % (name, value))
+                self.wfile.write("END\r\n")
+
+            elif command == "quit":
+                return
+
+            else:
+                self.wfile.write("ERROR\r\n")
+
+
+class CacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    """ A threaded memcached stand-in listening on address """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, max_entries=100000):
+        SocketServer.TCPServer.__init__(self, address, CacheRequestHandler)
+        self.store = CacheStore(max_entries)
+
+
+def start_in_thread(port=0):
+    """
+    Starts a server on localhost in a background thread and returns it. With
+    the default port of 0 a free port is picked, see server.server_address.
+    """
+    server = CacheServer(("127.0.0.1", port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11211
+    server = CacheServer(("127.0.0.1", port))
+    print("Cache server listening on port %d" % port)
+    server.serve_forever()
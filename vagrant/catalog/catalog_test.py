@@ -0,0 +1,858 @@
+#!/usr/bin/env python
+#
+# Test cases for the catalog app
+#
+# Runs against an in-memory database so an existing catalog.db is untouched.
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import flask
+from PIL import Image
+
+import app
+import avatars
+import benchmark
+import bulk
+import cache
+import category_stats
+import cache_server
+import fake_provider
+import jobs
+import metrics
+import providers
+import queries
+import ratelimit
+import search
+import sessions
+import tasks
+import templating
+from database_setup import (Base, User, Category, Item, Job, WebSession,
+                            create_db_engine)
+
+
+# Avatars cached by the tests go here rather than into the app's directory
+AVATAR_DIR = tempfile.mkdtemp()
+
+
+def setUp():
+    """
+    Binds the app to a fresh in-memory database and returns a client. Every
+    session shares its one connection, so workers must use a single thread.
+    """
+    engine = create_db_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    app.session.remove()
+    app.session.configure(bind=engine, info={"replica": None})
+    app.page_cache.clear()
+    app.session_cache.clear()
+    for limiter in app.rate_limiters.values():
+        limiter.reset()
+    app.app.testing = True
+    avatars.store = avatars.AvatarStore(AVATAR_DIR)
+    app.app.secret_key = "test"
+    return app.app.test_client()
+
+
+def seed(categories=3, items_per_category=5):
+    """Adds a user owning some categories and items, returns the user id"""
+    db = app.DBSession(bind=app.session.get_bind())
+    user = User(email="tester@example.com", name="Tester")
+    db.add(user)
+    db.flush()
+    for c in range(categories):
+        category = Category(name="Category %d" % c, timestamp=0,
+                            user_id=user.id)
+        db.add(category)
+        db.flush()
+        for i in range(items_per_category):
+            db.add(Item(name="Item %d-%d" % (c, i), description="",
+                        timestamp=0, category_id=category.id,
+                        user_id=user.id))
+    db.commit()
+    category_stats.repair_category_stats(db.connection())
+    db.commit()
+    user_id = user.id
+    db.close()
+    return user_id
+
+
+def testPagesWithinQueryBudget():
+    client = setUp()
+    seed()
+
+    # Each page raises QueryBudgetExceeded in testing mode if it lazy loads
+    for url in ["/", "/category/1", "/item/1", "/api/categories.json",
+                "/api/category/1.json", "/api/item/1.json"]:
+        response = client.get(url)
+        if response.status_code != 200:
+            raise ValueError("%s returned %d" % (url, response.status_code))
+
+    print("1. Catalog pages stay within their query budgets.")
+
+
+def testMissingPagesReturn404():
+    client = setUp()
+    seed()
+
+    for url in ["/category/100", "/item/100", "/api/category/100.json",
+                "/api/item/100.json"]:
+        response = client.get(url)
+        if response.status_code != 404:
+            raise ValueError("%s should return 404, not %d" %
+                             (url, response.status_code))
+
+    print("2. Missing categories and items return 404.")
+
+
+def testKeysetPagination():
+    client = setUp()
+    seed(categories=1, items_per_category=5)
+
+    seen = []
+    after_id = 0
+    while after_id is not None:
+        data = json.loads(client.get(
+            "/api/category/1.json?limit=2&after_id=%d" % after_id).data)
+        seen.extend(item["id"] for item in data["category"]["items"])
+        after_id = data["next_after_id"]
+    if seen != [1, 2, 3, 4, 5]:
+        raise ValueError("Paging through items should return each item once, "
+                         "in order, not %r" % seen)
+
+    lines = client.get("/api/category/1.ndjson").data.splitlines()
+    if len(lines) != 6 or json.loads(lines[0])["name"] != "Category 0":
+        raise ValueError("The NDJSON export should have the category on the "
+                         "first line followed by one line per item.")
+
+    print("3. Items can be paged through and streamed as NDJSON.")
+
+
+def logIn(client, user_id):
+    """Marks the client's cookie session as logged in as user_id"""
+    with client.session_transaction() as cookie_session:
+        cookie_session["email"] = "tester@example.com"
+        cookie_session["user_id"] = user_id
+
+
+def testConditionalGet():
+    client = setUp()
+    user_id = seed()
+
+    for url in ["/api/item/1.json", "/api/category/1.json", "/item/1"]:
+        etag = client.get(url).headers["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        if response.status_code != 304:
+            raise ValueError("%s should return 304 for a matching ETag" % url)
+
+    etag = client.get("/api/category/1.json").headers["ETag"]
+    logIn(client, user_id)
+    client.post("/item/1/edit", data={"name": "Renamed", "description": "",
+                                      "category": "1"})
+    response = client.get("/api/category/1.json",
+                          headers={"If-None-Match": etag})
+    if response.status_code != 200:
+        raise ValueError("Editing an item should change its category's ETag.")
+
+    print("4. Unchanged items and categories are answered with 304.")
+
+
+def testPageCacheEviction():
+    client = setUp()
+    user_id = seed()
+
+    client.get("/item/1")
+    misses = app.page_cache.stats()["misses"]
+    client.get("/item/1")
+    if app.page_cache.stats()["misses"] != misses:
+        raise ValueError("A repeated anonymous page view should be cached.")
+
+    client.get("/item/6")
+    logged_in = app.app.test_client()
+    logIn(logged_in, user_id)
+    logged_in.post("/category/1/edit", data={"name": "Renamed"})
+    if "Renamed" not in client.get("/item/1").data:
+        raise ValueError("Renaming a category should evict its item pages.")
+    misses = app.page_cache.stats()["misses"]
+    client.get("/item/6")
+    if app.page_cache.stats()["misses"] != misses:
+        raise ValueError("Renaming a category should keep the item pages of "
+                         "other categories.")
+
+    # A change evicted by another request while a page is rendered from the
+    # old data is not hidden by caching that page
+    render_template = app.render_template
+    engine = app.session.get_bind()
+
+    def rename():
+        engine.execute("UPDATE category SET name = 'Raced' WHERE id = 1")
+        app.evict_pages(category_ids=[1])
+
+    def renameWhileRendering(*args, **kwargs):
+        thread = threading.Thread(target=rename)
+        thread.start()
+        thread.join()
+        return render_template(*args, **kwargs)
+    app.render_template = renameWhileRendering
+    try:
+        client.get("/category/1")
+    finally:
+        app.render_template = render_template
+    if "Raced" not in client.get("/category/1").data:
+        raise ValueError("A page rendered during an eviction should not be "
+                         "cached.")
+
+    print("5. Anonymous pages are cached until a change evicts them.")
+
+
+def testSharedCacheBackend():
+    server = cache_server.start_in_thread()
+    url = "memcached://127.0.0.1:%d" % server.server_address[1]
+    worker1 = cache.create_cache(url, prefix="page:")
+    worker2 = cache.create_cache(url, prefix="page:")
+
+    worker1.set("item:1", ("<html>", [("ETag", "W/\"1\"")]))
+    if worker2.get("item:1") != ("<html>", [("ETag", "W/\"1\"")]):
+        raise ValueError("Entries should be visible to every worker.")
+    worker2.delete("item:1", "item:2")
+    if worker1.get("item:1") is not None:
+        raise ValueError("Evictions should be visible to every worker.")
+    if worker1.stats()["errors"] or worker2.stats()["errors"]:
+        raise ValueError("Every reply of the server should be understood.")
+
+    server.shutdown()
+    server.server_close()
+    print("6. The memcached backend is shared between workers.")
+
+
+def testSearch():
+    client = setUp()
+    user_id = seed(categories=2, items_per_category=3)
+
+    data = json.loads(client.get("/api/search.json?q=item+1").data)
+    names = sorted(item["name"] for item in data["items"])
+    if names != ["Item 0-1", "Item 1-0", "Item 1-1", "Item 1-2"]:
+        raise ValueError("Search should match every word, not %r" % names)
+
+    logIn(client, user_id)
+    client.post("/item/1/edit", data={"name": "Teapot", "description": "",
+                                      "category": "1"})
+    data = json.loads(client.get("/api/search.json?q=teapot").data)
+    if [item["id"] for item in data["items"]] != [1]:
+        raise ValueError("Edited items should be found by their new name.")
+
+    if client.get("/search?q=%22teapot").status_code != 200:
+        raise ValueError("Search text should not be parsed as FTS syntax.")
+
+    # Without the index, search scans with LIKE, where _ matches only itself
+    client.post("/item/2/edit", data={"name": "Tea_pot", "description": "",
+                                      "category": "1"})
+    client.post("/item/3/edit", data={"name": "Tea-pot", "description": "",
+                                      "category": "1"})
+    engine = app.session.get_bind()
+    search.index_available[engine] = False
+    try:
+        data = json.loads(client.get("/api/search.json?q=tea_pot").data)
+    finally:
+        del search.index_available[engine]
+    if [item["name"] for item in data["items"]] != ["Tea_pot"]:
+        raise ValueError("LIKE wildcards should be searched for literally.")
+
+    print("7. Items can be found by full-text search.")
+
+
+def testCategoryStats():
+    client = setUp()
+    user_id = seed(categories=2, items_per_category=2)
+    logIn(client, user_id)
+
+    client.post("/item/new", data={"name": "New", "description": "",
+                                   "category": "1"})
+    client.post("/item/1/edit", data={"name": "Moved", "description": "",
+                                      "category": "2"})
+    client.post("/item/3/delete")
+    counts = [c.item_count for c in app.session.query(Category)
+              .order_by(Category.id)]
+    if counts != [2, 2]:
+        raise ValueError("Item counts should follow item changes, not %r" %
+                         counts)
+
+    wrong = category_stats.check_category_stats(app.session.connection())
+    if wrong:
+        raise ValueError("Stored category stats should match a recount: %r" %
+                         wrong)
+
+    print("8. Category item counts are kept up to date.")
+
+
+def testFacebookLogin():
+    client = setUp()
+    delay = 0.2
+    server = fake_provider.start_in_thread(delay=delay)
+    app.facebook = providers.FacebookClient(base_url=server.url)
+    tasks.facebook = app.facebook
+
+    with client.session_transaction() as cookie_session:
+        cookie_session["state"] = "state"
+    started = time.time()
+    response = client.post("/auth/fbconnect?state=state", data="token")
+    elapsed = time.time() - started
+    if response.status_code != 200:
+        raise ValueError("Facebook login should succeed, not return %d" %
+                         response.status_code)
+    if elapsed >= 3 * delay:
+        raise ValueError("The profile and picture should be fetched "
+                         "concurrently, login took %.2fs" % elapsed)
+    if app.get_user_by_email(fake_provider.USER["email"]) is None:
+        raise ValueError("Logging in should create the user.")
+
+    client.get("/logout")
+    jobs.Worker(app.session.get_bind(), threads=1).run_pending()
+    if ("DELETE", "/%s/permissions" % fake_provider.USER["facebook_id"]) \
+            not in server.requests:
+        raise ValueError("Logging out should revoke the Facebook token.")
+    if app.session.query(Job).filter(Job.args != "[]").count():
+        raise ValueError("Jobs should not keep the token once done.")
+
+    server.shutdown()
+    server.server_close()
+    print("9. Facebook login and logout work against a fake provider.")
+
+
+def testDeleteCategoryInBackground():
+    client = setUp()
+    user_id = seed(categories=2, items_per_category=3)
+    logIn(client, user_id)
+
+    # Small categories are deleted at once, along with their items
+    client.post("/category/2/delete")
+    if app.session.query(Item).filter_by(category_id=2).count() or \
+            app.session.query(Job).count():
+        raise ValueError("Small categories should be deleted by the "
+                         "request.")
+
+    anonymous = app.app.test_client()
+    anonymous.get("/item/1")
+    app.SOFT_DELETE_MIN_ITEMS = 3
+    try:
+        client.post("/category/1/delete")
+    finally:
+        app.SOFT_DELETE_MIN_ITEMS = 1000
+    if anonymous.get("/item/1").status_code != 404:
+        raise ValueError("Deleting a category should evict its cached item "
+                         "pages.")
+    if client.get("/item/1").status_code != 404 or \
+            client.get("/category/1").status_code != 404 or \
+            json.loads(client.get("/api/categories.json").data)["categories"]:
+        raise ValueError("Deleted categories and their items should be "
+                         "hidden.")
+    if app.session.query(Item).count() != 3 or \
+            app.session.query(Job).filter_by(name="purge_category").count() \
+            != 1:
+        raise ValueError("Items should be deleted by the worker, not the "
+                         "request.")
+    if client.post("/item/new", data=dict(name="New", description="",
+                                          category=1)).status_code != 400:
+        raise ValueError("Items cannot be added to deleted categories.")
+
+    tasks.purge_category(app.session, 1, batch_size=2)
+    app.session.commit()
+    if app.session.query(Item).count() or app.session.query(Category).count():
+        raise ValueError("The worker should delete the category and its "
+                         "items.")
+
+    print("10. Large categories are deleted by a background job.")
+
+
+def testFailedJobsAreRetried():
+    setUp()
+    calls = []
+
+    @jobs.task
+    def failing_task(session, argument):
+        calls.append(argument)
+        raise RuntimeError("Failed")
+
+    jobs.enqueue(app.session, "failing_task", "argument")
+    app.session.commit()
+    worker = jobs.Worker(app.session.get_bind(), threads=1, max_attempts=2,
+                         retry_delay=0)
+    worker.run_pending()
+    worker.run_pending()
+    worker.run_pending()
+
+    job = app.session.query(Job).one()
+    if calls != ["argument", "argument"] or job.status != "failed":
+        raise ValueError("A failing job should be attempted max_attempts "
+                         "times, then marked as failed.")
+    if job.args != "[]":
+        raise ValueError("A failed job should not keep its arguments.")
+
+    jobs.delete_finished_jobs(app.session, retention=0)
+    app.session.commit()
+    if app.session.query(Job).count():
+        raise ValueError("Finished jobs should be deleted after the "
+                         "retention period.")
+
+    def failing_claim():
+        raise RuntimeError("Database unavailable")
+    worker.claim = failing_claim
+    for _ in range(worker.threads + 1):
+        try:
+            worker.run_pending()
+        except RuntimeError:
+            pass
+    del worker.claim
+    if worker.run_pending() != 0:
+        raise ValueError("A failed claim should free its thread slot.")
+
+    print("11. Failed jobs are retried, given up on and deleted.")
+
+
+def testMetrics():
+    client = setUp()
+    seed()
+
+    client.get("/")
+    client.get("/item/1")
+    text = client.get("/_metrics").data
+    for line in ['catalog_requests_total{method="GET",route="/",status="200"}',
+                 'catalog_sql_queries_per_request_count{route="/item/<int:'
+                 'item_id>"}',
+                 'catalog_template_render_seconds_count{template='
+                 '"categories.html"}',
+                 'catalog_cache{cache="page",stat="entries"}']:
+        if line not in text:
+            raise ValueError("Metrics should include %s" % line)
+
+    # A failed statement leaves nothing behind on its connection
+    connection = app.session.get_bind().connect()
+    try:
+        connection.execute("SELECT * FROM missing_table")
+    except Exception:
+        pass
+    if connection.info.get("query_started"):
+        raise ValueError("Failed statements should not leave their start "
+                         "time on the connection.")
+    connection.close()
+
+    # Every request is profiled and slower than 0 seconds, so is saved
+    profile_dir = tempfile.mkdtemp()
+    try:
+        other = flask.Flask(__name__)
+        other.route("/")(lambda: "")
+        metrics.instrument(other, profile_threshold=0, profile_rate=1,
+                           profile_dir=profile_dir)
+        other.test_client().get("/")
+        if len(os.listdir(profile_dir)) != 1:
+            raise ValueError("Slow requests should be profiled.")
+    finally:
+        shutil.rmtree(profile_dir)
+
+    print("12. Request metrics and slow request profiles are recorded.")
+
+
+def testBenchmark():
+    setUp()
+    # The server runs requests on several threads, so needs a database file
+    # rather than the single shared connection of an in-memory one
+    directory = tempfile.mkdtemp()
+    limiters = dict(app.rate_limiters)
+    bind = app.session.get_bind()
+    try:
+        engine = create_db_engine("sqlite:///%s/benchmark.db" % directory)
+        benchmark.seed(engine, categories=3, items_per_category=4, users=2)
+        results = benchmark.benchmark(engine, categories=3, items=12,
+                                      requests_per_route=5, threads=2)
+    finally:
+        shutil.rmtree(directory)
+
+    if app.rate_limiters != limiters:
+        raise ValueError("The benchmark should put back the rate limits.")
+    if app.session.get_bind() is not bind:
+        raise ValueError("The benchmark should put back the app's engine.")
+
+    if len(results) != len(benchmark.ROUTES) * 2 * 2:
+        raise ValueError("Every route should be run in both modes, "
+                         "anonymously and logged in.")
+    for result in results:
+        if result["errors"] or result["p99_ms"] is None:
+            raise ValueError("Benchmarked requests should succeed: %r" %
+                             result)
+
+    print("13. The benchmark seeds data and runs every route.")
+
+
+def testCompiledAndCachedTemplates():
+    client = setUp()
+    user_id = seed()
+
+    # Compiled templates are written to the bytecode cache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        other = flask.Flask(app.__name__)
+        templating.configure_templates(other, cache_dir)
+        names = templating.compile_templates(other)
+        if "top_bar.html" not in names or \
+                len(os.listdir(cache_dir)) != len(names):
+            raise ValueError("Every template should be compiled to "
+                             "bytecode.")
+    finally:
+        shutil.rmtree(cache_dir)
+
+    # The top bar is rendered once per login state
+    fragments = app.app.jinja_env.fragment_cache
+    fragments.clear()
+    client.get("/search?q=item")
+    client.get("/search?q=other")
+    if fragments.stats()["entries"] != 1 or fragments.stats()["hits"] < 1:
+        raise ValueError("The top bar should be rendered from the cache.")
+
+    logIn(client, user_id)
+    if "Log out" not in client.get("/search?q=item").data:
+        raise ValueError("Logged in users should get their own top bar.")
+
+    print("14. Templates are compiled ahead of time and fragments cached.")
+
+
+def sessionCookie(client):
+    """Returns the value of the client's session cookie, or None"""
+    for cookie in client.cookie_jar:
+        if cookie.name == app.app.session_cookie_name:
+            return cookie.value
+    return None
+
+
+def testServerSideSessions():
+    client = setUp()
+    seed()
+
+    client.get("/")
+    if sessionCookie(client) is not None or \
+            app.session.query(WebSession).count():
+        raise ValueError("Anonymous page views should not create sessions.")
+
+    client.get("/login")
+    record = app.session.query(WebSession).one()
+    if sessionCookie(client) != record.id or "state" not in record.data:
+        raise ValueError("The cookie should only hold the session's id.")
+
+    # Sessions are read from the cache, and from the table on a miss
+    app.session_cache.clear()
+    state = json.loads(record.data)["state"]
+    if client.post("/auth/fbconnect?state=wrong").status_code != 401 or \
+            client.get("/login").status_code != 200:
+        raise ValueError("Sessions should be loaded from the database.")
+    app.session.expire_all()
+    if json.loads(app.session.query(WebSession).one().data)["state"] == \
+            state:
+        raise ValueError("Changed sessions should be stored.")
+
+    app.session.query(WebSession).update({WebSession.expires_at: 0})
+    app.session.commit()
+    app.session_cache.clear()
+    deleted = sessions.delete_expired_sessions(app.session)
+    app.session.commit()
+    if deleted != 1 or app.session.query(WebSession).count():
+        raise ValueError("Expired sessions should be deleted.")
+
+    # A session whose user has been deleted is dropped
+    user = User(email="gone@example.com", name="Gone")
+    app.session.add(user)
+    app.session.commit()
+    logIn(client, user.id)
+    app.session.delete(user)
+    app.session.commit()
+    app.user_cache.clear()
+    if client.get("/").status_code != 200 or \
+            sessionCookie(client) is not None or \
+            app.session.query(WebSession).count():
+        raise ValueError("Sessions of deleted users should be dropped.")
+
+    print("15. Sessions are stored server-side.")
+
+
+def testReadReplica():
+    client = setUp()
+    directory = tempfile.mkdtemp()
+    try:
+        primary = create_db_engine("sqlite:///%s/primary.db" % directory)
+        Base.metadata.create_all(primary)
+        app.session.configure(bind=primary)
+        user_id = seed()
+        primary.dispose()
+
+        # The replica starts as a copy of the primary
+        shutil.copy("%s/primary.db" % directory, "%s/replica.db" % directory)
+        replica = create_db_engine("sqlite:///%s/replica.db" % directory)
+        app.session.remove()
+        app.session.configure(info={"replica": replica})
+
+        def categoryName(client):
+            data = client.get("/api/category/1.json").data
+            return json.loads(data)["category"]["name"]
+
+        replica.execute("UPDATE category SET name = 'Replica' WHERE id = 1")
+        if categoryName(client) != "Replica":
+            raise ValueError("Reads should go to the replica.")
+
+        logIn(client, user_id)
+        client.post("/category/1/edit", data=dict(name="Edited"))
+        if categoryName(client) != "Edited":
+            raise ValueError("Users should read their own writes.")
+        if categoryName(app.app.test_client()) != "Replica":
+            raise ValueError("Other users should keep reading the replica.")
+        if primary.execute("SELECT name FROM category WHERE id = 1") \
+                .scalar() != "Edited":
+            raise ValueError("Writes should go to the primary.")
+
+        with client.session_transaction() as cookie_session:
+            cookie_session["primary_until"] = 0
+        if categoryName(client) != "Replica":
+            raise ValueError("Reads should return to the replica.")
+
+        # Statements on the primary count against the query budget of a
+        # view that started out reading from the replica
+        def addCategory():
+            app.session.add(Category(name="Counted", timestamp=0))
+            app.session.flush()
+        with app.app.test_request_context("/"):
+            try:
+                app.query_budget(0)(addCategory)()
+            except queries.QueryBudgetExceeded:
+                pass
+            else:
+                raise ValueError("The query budget should count statements "
+                                 "on every engine.")
+            finally:
+                app.session.rollback()
+
+        # Pages rendered from a replica that may lag are not cached
+        app.app.test_client().get("/category/1")
+        if app.page_cache.get("category:1") is not None:
+            raise ValueError("Pages should not be cached from a lagging "
+                             "replica.")
+    finally:
+        app.session.remove()
+        shutil.rmtree(directory)
+
+    print("16. GET requests read from a replica, writes go to the primary.")
+
+
+def testAvatarCache():
+    client = setUp()
+    server = fake_provider.start_in_thread()
+    try:
+        user = User(email="tester@example.com", name="Tester",
+                    picture=server.url + "/picture.png")
+        app.session.add(user)
+        app.session.commit()
+        user_id = user.id
+        url = "/avatar/%d" % user_id
+        if client.get(url).status_code != 302:
+            raise ValueError("Uncached avatars should redirect to the "
+                             "original picture.")
+
+        jobs.enqueue(app.session, "cache_avatar", user_id)
+        app.session.commit()
+        jobs.Worker(app.session.get_bind(), threads=1).run_pending()
+        avatar = app.session.query(User.avatar).filter_by(id=user_id).scalar()
+        if avatar is None:
+            raise ValueError("The worker should cache the user's picture.")
+
+        response = client.get(url + "?size=40")
+        if response.mimetype != "image/jpeg" or \
+                Image.open(io.BytesIO(response.data)).size != (48, 48) or \
+                response.cache_control.max_age != app.AVATAR_MAX_AGE:
+            raise ValueError("Avatars should be served as cached "
+                             "thumbnails.")
+
+        response = client.get(url + "?size=200&v=" + avatar)
+        if Image.open(io.BytesIO(response.data)).size != (200, 200) or \
+                response.cache_control.max_age != \
+                app.AVATAR_VERSIONED_MAX_AGE:
+            raise ValueError("Versioned avatar URLs should be cached for "
+                             "long.")
+
+        app.app.use_x_sendfile = True
+        try:
+            response = client.get(url)
+        finally:
+            app.app.use_x_sendfile = False
+        if response.headers.get("X-Sendfile") != \
+                avatars.store.path(avatar, 48) or response.data:
+            raise ValueError("Avatars should be sent by the front end "
+                             "server when X-Sendfile is enabled.")
+
+        os.remove(avatars.store.path(avatar, 48))
+        if client.get(url).status_code != 302:
+            raise ValueError("Avatars missing from disk should redirect to "
+                             "the original picture.")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("17. User pictures are cached and served as thumbnails.")
+
+
+def testRateLimits():
+    client = setUp()
+    user_id = seed()
+    limiters = dict(app.rate_limiters)
+    app.rate_limiters.update(read=ratelimit.TokenBucketLimiter(5, 60),
+                             write=ratelimit.TokenBucketLimiter(2, 60))
+    try:
+        statuses = [client.get("/").status_code for _ in range(6)]
+        if statuses != [200] * 5 + [429]:
+            raise ValueError("Reads over the budget should be refused.")
+        response = client.get("/api/categories.json")
+        if response.status_code != 429 or \
+                response.headers.get("Retry-After") != "12":
+            raise ValueError("Refused requests should say when to retry.")
+        response = client.get("/_metrics")
+        if response.status_code != 200 or \
+                'catalog_rate_limited_total{budget="read"} 2' not in \
+                response.data:
+            raise ValueError("Refused requests should be counted.")
+
+        if client.get("/avatar/%d" % user_id).status_code == 429:
+            raise ValueError("Avatars should not be rate limited.")
+        client.set_cookie("localhost", app.app.session_cookie_name, "made-up")
+        if client.get("/").status_code != 429:
+            raise ValueError("A made-up session cookie should not get a new "
+                             "budget.")
+        logIn(client, user_id)
+        if client.get("/").status_code != 200:
+            raise ValueError("Each session should have its own budget.")
+
+        other = app.app.test_client()
+        environ = {"REMOTE_ADDR": "10.0.0.2"}
+        if other.get("/", environ_base=environ).status_code != 200:
+            raise ValueError("Each client should have its own budget.")
+        statuses = [other.post("/item/new", environ_base=environ).status_code
+                    for _ in range(3)]
+        if statuses != [401, 401, 429] or \
+                other.get("/", environ_base=environ).status_code != 200:
+            raise ValueError("Writes should have a budget of their own.")
+
+        limiter = ratelimit.TokenBucketLimiter(1, 60, max_keys=2)
+        for key in ("a", "b", "c"):
+            limiter.hit(key)
+        if limiter.stats()["keys"] != 2:
+            raise ValueError("Limiters should track a bounded number of "
+                             "clients.")
+    finally:
+        app.rate_limiters.clear()
+        app.rate_limiters.update(limiters)
+
+    server = cache_server.start_in_thread()
+    try:
+        url = "memcached://127.0.0.1:%d" % server.server_address[1]
+        worker1 = ratelimit.create_limiter(url, "3/60", prefix="rate:")
+        worker2 = ratelimit.create_limiter(url, "3/60", prefix="rate:")
+        waits = [worker.hit("ip:10.0.0.1")
+                 for worker in (worker1, worker2, worker1, worker2)]
+        if waits[:3] != [0, 0, 0] or not waits[3] > 0:
+            raise ValueError("A shared limit should hold across workers.")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("18. Clients over their read or write budget get a 429.")
+
+
+def exportedItems(engine):
+    """Returns the items exported by bulk.py as tuples"""
+    return [(row["id"], row["name"], row["description"], row["timestamp"],
+             row["version"], row["category_id"], row["user_id"])
+            for row in bulk.export_rows(engine, Item.__table__, batch_size=2)]
+
+
+def testBulkImportExport():
+    setUp()
+    seed(categories=1, items_per_category=0)
+    engine = app.session.get_bind()
+    table = Item.__table__
+
+    # Blank integers are null in CSV, while blank text stays text. Unknown
+    # columns and extra fields are ignored, and missing columns take their
+    # defaults
+    rows = bulk.read_rows(io.BytesIO(
+        "name,description,timestamp,category_id,user_id,unknown\n"
+        "Teapot,,5,1,1,x,extra\n"
+        "T\xc3\xa9l\xc3\xa9,\"Has, a comma\",6,1,\n"), "csv")
+    if bulk.import_rows(engine, table, rows, batch_size=1) != 2:
+        raise ValueError("Every CSV row should be imported.")
+    rows = bulk.read_rows(io.BytesIO(
+        '{"name": "Kettle", "description": null, "timestamp": "7", '
+        '"category_id": 1, "user_id": null}\n\n'), "ndjson")
+    if bulk.import_rows(engine, table, rows) != 1:
+        raise ValueError("Every NDJSON row should be imported.")
+
+    # A column given by the first row but left out of a later one takes its
+    # default rather than null
+    rows = bulk.read_rows(io.BytesIO(
+        '{"name": "Cup", "timestamp": 8, "version": 3, "category_id": 1}\n'
+        '{"name": "Mug", "timestamp": 9, "category_id": 1}\n'), "ndjson")
+    if bulk.import_rows(engine, table, rows) != 2:
+        raise ValueError("Rows with different columns should be imported.")
+
+    expected = [(1, u"Teapot", u"", 5, 1, 1, 1),
+                (2, u"T\xe9l\xe9", u"Has, a comma", 6, 1, 1, None),
+                (3, u"Kettle", None, 7, 1, 1, None),
+                (4, u"Cup", None, 8, 3, 1, None),
+                (5, u"Mug", None, 9, 1, 1, None)]
+    if exportedItems(engine) != expected:
+        raise ValueError("Imported values should be converted to the types "
+                         "of their columns: %r" % exportedItems(engine))
+
+    for fmt in ("csv", "ndjson"):
+        f = io.BytesIO()
+        if bulk.write_rows(f, fmt, table,
+                           bulk.export_rows(engine, table)) != 5:
+            raise ValueError("Every row should be exported.")
+
+        # Imported again into an empty database, the rows come out the
+        # same, except that CSV cannot tell null text from blank text
+        setUp()
+        seed(categories=1, items_per_category=0)
+        engine = app.session.get_bind()
+        bulk.import_rows(engine, table,
+                         bulk.read_rows(io.BytesIO(f.getvalue()), fmt))
+        if fmt == "csv":
+            expected = [row[:2] + (row[2] or u"",) + row[3:]
+                        for row in expected]
+        if exportedItems(engine) != expected:
+            raise ValueError("Items should survive a round trip through %s: "
+                             "%r" % (fmt, exportedItems(engine)))
+
+    print("19. Items can be imported and exported as CSV and NDJSON.")
+
+
+if __name__ == '__main__':
+    testPagesWithinQueryBudget()
+    testMissingPagesReturn404()
+    testKeysetPagination()
+    testConditionalGet()
+    testPageCacheEviction()
+    testSharedCacheBackend()
+    testSearch()
+    testCategoryStats()
+    testFacebookLogin()
+    testDeleteCategoryInBackground()
+    testFailedJobsAreRetried()
+    testMetrics()
+    testBenchmark()
+    testCompiledAndCachedTemplates()
+    testServerSideSessions()
+    testReadReplica()
+    testAvatarCache()
+    testRateLimits()
+    testBulkImportExport()
+    shutil.rmtree(AVATAR_DIR)
+    print("Success!  All tests pass!")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Checks and repairs the denormalized Category.item_count and last_item_at
+
+The app keeps these columns up to date as items change, but writes made
+outside it, such as bulk imports, can leave them out of date. "check" lists
+categories whose stored values differ from their items and "repair"
+recomputes every category from scratch in a single statement.
+
+Usage: python category_stats.py check|repair [database url]
+"""
+
+import sys
+
+from sqlalchemy import select, func, or_, and_
+
+from database_setup import DATABASE_URL, Category, Item, create_db_engine
+
+category = Category.__table__
+item = Item.__table__
+
+
+def item_count_of(category_id):
+    """ Scalar subquery counting the items of a category """
+    return (select([func.count(item.c.id)])
+            .where(item.c.category_id == category_id).as_scalar())
+
+
+def last_item_at_of(category_id):
+    """ Scalar subquery for the newest item timestamp of a category """
+    return (select([func.max(item.c.timestamp)])
+            .where(item.c.category_id == category_id).as_scalar())
+
+
+def check_category_stats(connection):
+    """
+    Returns (id, item_count, last_item_at, actual_count, actual_last_item_at)
+    for every category whose stored values are wrong
+    """
+    actual_count = item_count_of(category.c.id)
+    actual_last = last_item_at_of(category.c.id)
+    stored_last = category.c.last_item_at
+
+    mismatched = or_(
+        category.c.item_count != actual_count,
+        and_(stored_last.is_(None), actual_last.isnot(None)),
+        and_(stored_last.isnot(None), actual_last.is_(None)),
+        stored_last != actual_last)
+    query = select([category.c.id, category.c.item_count, stored_last,
+                    actual_count, actual_last]).where(mismatched)
+    return connection.execute(query).fetchall()
+
+
+def repair_category_stats(connection):
+    """ Recomputes the stats of every category from its items """
+    connection.execute(category.update().values(
+        item_count=item_count_of(category.c.id),
+        last_item_at=last_item_at_of(category.c.id)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("check", "repair"):
+        sys.exit(__doc__)
+
+    url = sys.argv[2] if len(sys.argv) > 2 else DATABASE_URL
+    with create_db_engine(url).begin() as connection:
+        if sys.argv[1] == "check":
+            wrong = check_category_stats(connection)
+            for row in wrong:
+                print("Category %d: stored %r/%r, actual %r/%r" % tuple(row))
+            print("%d categories out of date" % len(wrong))
+            sys.exit(1 if wrong else 0)
+
+        repair_category_stats(connection)
+        print("Category stats repaired")
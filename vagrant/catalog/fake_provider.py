@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+A fake Google and Facebook API server for development and tests
+
+Answers the endpoints used by providers.py with a fixed user, accepting any
+token, and serves the user's picture as a generated PNG at /picture.png.
+Every request is recorded in server.requests as (method, path), and an
+optional delay simulates the latency of the real services.
+
+Point the clients at it with e.g. FacebookClient(base_url=server.url).
+
+Usage: python fake_provider.py [port]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import struct
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+# The user returned by both providers. Their picture is served by the server
+USER = {
+    "email": "fake.user@example.com",
+    "name": "Fake User",
+    "google_id": "1234567890",
+    "facebook_id": "9876543210",
+}
+
+
+def png_image(width, height, color):
+    """ Returns a PNG of the given size filled with an (r, g, b) color """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    row = b"\x00" + struct.pack("BBB", *color) * width
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0,
+                                       0)) +
+            chunk(b"IDAT", zlib.compress(row * height)) +
+            chunk(b"IEND", b""))
+
+
+class FakeProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """ Serves the fake API endpoints """
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_DELETE(self):
+        self.respond("DELETE")
+
+    def respond(self, method):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append((method, url.path))
+        time.sleep(self.server.delay)
+
+        body = self.route(method, url.path, params)
+        if body is None:
+            self.send_response(404)
+            body = {"error": "not_found"}
+        else:
+            self.send_response(200)
+
+        if isinstance(body, dict):
+            body = json.dumps(body)
+            self.send_header("Content-Type", "application/json")
+        elif isinstance(body, tuple):
+            body, content_type = body
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method, path, params):
+        """ Returns the body for a request, or None for unknown paths """
+        if path == "/oauth2/v1/tokeninfo":
+            return {"user_id": USER["google_id"],
+                    "issued_to": self.server.google_client_id}
+        if path == "/oauth2/v1/userinfo":
+            return {"email": USER["email"], "name": USER["name"],
+                    "picture": self.server.url + "/picture.png"}
+        if path == "/o/oauth2/revoke":
+            return {}
+        if path == "/oauth/access_token":
+            return "access_token=long-%s&expires=5183999" % \
+                params.get("fb_exchange_token")
+        if path == "/v2.5/me":
+            return {"id": USER["facebook_id"], "name": USER["name"],
+                    "email": USER["email"]}
+        if path == "/v2.5/me/picture":
+            return {"data": {"url": self.server.url + "/picture.png"}}
+        if path == "/picture.png":
+            return png_image(300, 200, (200, 80, 40)), "image/png"
+        if method == "DELETE" and path.endswith("/permissions"):
+            return {"success": True}
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProviderServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+
+    """ A threaded fake provider listening on address """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, delay=0, google_client_id=""):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeProviderHandler)
+        self.delay = delay
+        self.google_client_id = google_client_id
+        self.requests = []
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+
+def start_in_thread(port=0, **kwargs):
+    """
+    Starts a fake provider on localhost in a background thread and returns
+    it. With the default port of 0 a free port is picked.
+    """
+    server = FakeProviderServer(("127.0.0.1", port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    server = FakeProviderServer(("127.0.0.1", port))
+    print("Fake provider listening on %s" % server.url)
+    server.serve_forever()
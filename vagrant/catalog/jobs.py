@@ -0,0 +1,237 @@
+"""
+A durable job queue stored in the catalog database
+
+The app calls enqueue() to add a Job to the session of the change that needs
+it, so the job is committed, or rolled back, together with that change.
+Worker runs due jobs on a thread pool. A failed job is retried with
+exponential backoff until it has been attempted max_attempts times.
+
+Tasks are plain functions registered with @task. They are called with a
+database session followed by the arguments they were queued with. The
+arguments are cleared once a job is done or has failed for good, and
+delete_finished_jobs() deletes the job after JOB_RETENTION seconds.
+"""
+
+import json
+import logging
+import threading
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import Job
+
+log = logging.getLogger(__name__)
+
+# Registered task functions by name
+TASKS = {}
+
+# Seconds to keep done and failed jobs for job_stats()
+JOB_RETENTION = 7 * 24 * 3600
+
+
+def task(f):
+    """ Registers f so that jobs can be queued for it by name """
+    TASKS[f.__name__] = f
+    return f
+
+
+def enqueue(session, name, *args):
+    """
+    Adds a job running task name with args to session. It is queued once the
+    session is committed. args must be JSON serializable.
+    """
+    now = time.time()
+    job = Job(name=name, args=json.dumps(args), created_at=now, run_at=now)
+    session.add(job)
+    return job
+
+
+def delete_finished_jobs(session, retention=JOB_RETENTION):
+    """
+    Deletes the done and failed jobs that finished more than retention
+    seconds ago. Returns the number deleted.
+    """
+    return (session.query(Job)
+            .filter(Job.status.in_(("done", "failed")),
+                    Job.finished_at < time.time() - retention)
+            .delete(synchronize_session=False))
+
+
+def job_stats(session):
+    """
+    Returns per-task job counts and latencies, as a list of dicts. wait is
+    the time between queueing and starting a job, run its running time, both
+    averaged over finished jobs.
+    """
+    wait = Job.started_at - Job.created_at
+    run = Job.finished_at - Job.started_at
+    rows = (session.query(Job.name, Job.status, func.count(Job.id),
+                          func.avg(wait), func.max(wait), func.avg(run),
+                          func.max(run))
+            .group_by(Job.name, Job.status)
+            .order_by(Job.name, Job.status))
+    return [dict(zip(("name", "status", "count", "avg_wait", "max_wait",
+                      "avg_run", "max_run"), row)) for row in rows]
+
+
+class Worker(object):
+
+    """
+    Claims due jobs and runs them on a pool of threads
+
+    Several workers, in any number of processes, can share one database:
+    claiming a job is a conditional update that only one of them can win.
+    """
+
+    def __init__(self, engine, threads=4, poll_interval=1.0, max_attempts=5,
+                 retry_delay=5.0, stale_after=600):
+        self.Session = sessionmaker(bind=engine)
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        # Jobs claimed but not yet finished by this worker
+        self.running = threading.Semaphore(threads)
+        # [interval, function, last run] of functions called by run_forever
+        self.periodic = []
+
+    def claim(self):
+        """ Marks the next due job as running and returns its id, or None """
+        session = self.Session()
+        try:
+            while True:
+                now = time.time()
+                job_id = (session.query(Job.id)
+                          .filter(Job.status == "queued", Job.run_at <= now)
+                          .order_by(Job.run_at).limit(1).scalar())
+                if job_id is None:
+                    return None
+
+                claimed = (session.query(Job)
+                           .filter(Job.id == job_id, Job.status == "queued")
+                           .update({Job.status: "running",
+                                    Job.started_at: now,
+                                    Job.attempts: Job.attempts + 1},
+                                   synchronize_session=False))
+                session.commit()
+                if claimed:
+                    return job_id
+                # Another worker claimed it first
+        finally:
+            session.close()
+
+    def run(self, job_id):
+        """ Runs a claimed job and records the outcome """
+        session = self.Session()
+        try:
+            job = session.query(Job).filter_by(id=job_id).one()
+            try:
+                TASKS[job.name](session, *json.loads(job.args))
+                session.commit()
+            except Exception:
+                session.rollback()
+                job = session.query(Job).filter_by(id=job_id).one()
+                self.failed(job, traceback.format_exc())
+            else:
+                job.status = "done"
+                job.finished_at = time.time()
+                job.args = json.dumps([])
+            session.commit()
+        finally:
+            session.close()
+            self.running.release()
+
+    def failed(self, job, error):
+        """ Schedules a retry of a failed job, or gives up on it """
+        log.warning("Job %d (%s) failed on attempt %d:\n%s", job.id, job.name,
+                    job.attempts, error)
+        job.last_error = error
+        if job.attempts >= self.max_attempts:
+            job.status = "failed"
+            job.finished_at = time.time()
+            # Arguments such as OAuth tokens are not kept any longer
+            job.args = json.dumps([])
+        else:
+            job.status = "queued"
+            job.run_at = time.time() + \
+                self.retry_delay * 2 ** (job.attempts - 1)
+
+    def requeue_stale(self):
+        """
+        Returns jobs left running for longer than stale_after seconds, e.g.
+        by a worker that was killed, to the queue
+        """
+        session = self.Session()
+        try:
+            (session.query(Job)
+             .filter(Job.status == "running",
+                     Job.started_at < time.time() - self.stale_after)
+             .update({Job.status: "queued"}, synchronize_session=False))
+            session.commit()
+        finally:
+            session.close()
+
+    def run_pending(self):
+        """
+        Runs jobs until none are due, then waits for them to finish. Returns
+        the number of jobs run.
+        """
+        count = 0
+        while True:
+            self.running.acquire()
+            try:
+                job_id = self.claim()
+            except Exception:
+                # Free the slot, or waiting for running jobs would hang
+                self.running.release()
+                raise
+            if job_id is None:
+                self.running.release()
+                break
+            self.pool.apply_async(self.run, (job_id,))
+            count += 1
+
+        # Wait for every running job by taking all of the slots
+        for _ in range(self.threads):
+            self.running.acquire()
+        for _ in range(self.threads):
+            self.running.release()
+        return count
+
+    def every(self, interval, f):
+        """
+        Has run_forever call f with a database session at most every
+        interval seconds, for housekeeping that is not queued as jobs
+        """
+        self.periodic.append([interval, f, 0])
+
+    def run_periodic(self):
+        """ Calls the periodic functions that are due """
+        for entry in self.periodic:
+            interval, f, last_run = entry
+            if time.time() - last_run < interval:
+                continue
+            entry[2] = time.time()
+            session = self.Session()
+            try:
+                f(session)
+                session.commit()
+            except Exception:
+                log.exception("Periodic %s failed", f.__name__)
+            finally:
+                session.close()
+
+    def run_forever(self):
+        """ Polls for due jobs every poll_interval seconds """
+        self.requeue_stale()
+        while True:
+            self.run_periodic()
+            if not self.run_pending():
+                time.sleep(self.poll_interval)
@@ -0,0 +1,256 @@
+"""
+Request timing and SQL profiling for the catalog app
+
+instrument() hooks into a Flask app and SQLAlchemy to record, per route, the
+wall time of each request, the number of SQL statements it ran and the time
+spent in them, along with the time spent rendering each template. Everything
+is kept in memory in a Registry and rendered in the Prometheus text format.
+
+Requests can also be profiled. A sample of requests runs under cProfile, and
+the profile of any that took longer than a threshold is written to a .pstats
+file, which can be read with "python -m pstats <file>".
+"""
+
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets, in seconds or statements
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(labels):
+    """ Formats a tuple of (name, value) pairs as {name="value",...} """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    """ A count per set of labels that only goes up """
+
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Histogram(object):
+
+    """ Observations per set of labels, counted in cumulative buckets """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # Per set of labels: [counts per bucket, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((self.name + "_bucket",
+                                    key + (("le", format_value(bound)),),
+                                    bucket_count))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, count))
+        return samples
+
+
+class Gauge(object):
+
+    """ Values read from a callback each time metrics are rendered """
+
+    type = "gauge"
+
+    def __init__(self, name, help, collect):
+        """ collect returns a list of (labels dict, value) pairs """
+        self.name = name
+        self.help = help
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels.items())), value)
+                for labels, value in self.collect()]
+
+
+class Registry(object):
+
+    """ The set of metrics rendered by the metrics endpoint """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns every metric in the Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, format_labels(labels),
+                                          format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.add(Counter(
+    "catalog_requests_total", "Requests handled, by route and status"))
+request_seconds = registry.add(Histogram(
+    "catalog_request_duration_seconds", "Wall time of requests by route"))
+sql_queries = registry.add(Histogram(
+    "catalog_sql_queries_per_request", "SQL statements run per request",
+    COUNT_BUCKETS))
+sql_seconds = registry.add(Histogram(
+    "catalog_sql_duration_seconds", "Time spent in SQL per request"))
+render_seconds = registry.add(Histogram(
+    "catalog_template_render_seconds", "Time spent rendering each template"))
+profiles_written = registry.add(Counter(
+    "catalog_profiles_written_total", "Slow request profiles written"))
+
+
+class TimedTemplate(Template):
+
+    """ A Jinja template that records how long each render takes """
+
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            render_seconds.observe(time.time() - started,
+                                   template=self.name or "<string>")
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # Kept on the statement's own context, which is discarded along with it
+    # when the statement fails and after_cursor_execute is never called
+    context._query_started = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.time() - context._query_started
+    # Statements run outside of a request, e.g. by a worker, are ignored
+    if has_request_context() and hasattr(g, "sql_count"):
+        g.sql_count += 1
+        g.sql_time += elapsed
+
+
+def route_name():
+    """ The URL rule of the current request, e.g. /item/<int:item_id> """
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def instrument(app, profile_threshold=None, profile_rate=0.01,
+               profile_dir="profiles"):
+    """
+    Records the metrics of every request handled by app. If
+    profile_threshold is given, a profile_rate fraction of requests is
+    profiled and those slower than profile_threshold seconds are saved to
+    profile_dir.
+    """
+    app.jinja_env.template_class = TimedTemplate
+
+    if not event.contains(Engine, "before_cursor_execute",
+                          before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def start_timing():
+        g.request_started = time.time()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.profiler = None
+        if profile_threshold is not None and random.random() < profile_rate:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_timing(response):
+        if not hasattr(g, "request_started"):
+            return response
+
+        elapsed = time.time() - g.request_started
+        route = route_name()
+        requests_total.inc(route=route, method=request.method,
+                           status=response.status_code)
+        request_seconds.observe(elapsed, route=route)
+        sql_queries.observe(g.sql_count, route=route)
+        sql_seconds.observe(g.sql_time, route=route)
+
+        if g.profiler is not None:
+            g.profiler.disable()
+            if elapsed >= profile_threshold:
+                save_profile(g.profiler, profile_dir, route, elapsed)
+        return response
+
+
+def save_profile(profiler, profile_dir, route, elapsed):
+    """ Writes a profile to profile_dir, named after its time and route """
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    name = "%d-%s-%dms.pstats" % (time.time() * 1000,
+                                  re.sub(r"\W+", "_", route).strip("_"),
+                                  elapsed * 1000)
+    profiler.dump_stats(os.path.join(profile_dir, name))
+    profiles_written.inc()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Brings an existing catalog database up to date with database_setup.py
+
+Base.metadata.create_all() only creates tables that do not exist yet, so
+changes to existing tables such as new indexes are applied here instead. Every
+step checks the current schema first and can be run any number of times.
+
+Usage: python migrate.py [database url]
+"""
+
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateTable
+
+from database_setup import (Base, DATABASE_URL, Item, SEARCH_INDEX_DDL,
+                            create_db_engine, has_search_index,
+                            supports_search_index)
+from search import rebuild_search_index
+from category_stats import repair_category_stats
+
+
+def create_missing_tables(engine):
+    """ Creates tables that do not exist yet """
+    Base.metadata.create_all(engine)
+
+
+def add_missing_columns(engine):
+    """
+    Adds columns declared on the models but missing in the database. New
+    columns must be nullable or have a server default to fill existing rows.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+
+    for table in Base.metadata.sorted_tables:
+        existing = set(column["name"]
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                quote(table.name), quote(column.name),
+                column.type.compile(engine.dialect))
+            if column.server_default is not None:
+                ddl += " DEFAULT %s" % column.server_default.arg
+            if not column.nullable:
+                ddl += " NOT NULL"
+
+            engine.execute(ddl)
+            print("Added column %s.%s" % (table.name, column.name))
+
+
+def create_missing_indexes(engine):
+    """ Creates indexes declared on the models but missing in the database """
+    inspector = inspect(engine)
+    created = []
+
+    for table in Base.metadata.sorted_tables:
+        existing = set(index["name"]
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+
+    if created:
+        # Refresh the planner statistics so the new indexes are used
+        if engine.dialect.name == "sqlite":
+            engine.execute("ANALYZE")
+        print("Created indexes: %s" % ", ".join(created))
+
+
+def add_item_category_cascade(engine):
+    """
+    Recreates the item table with ON DELETE CASCADE on category_id, as
+    SQLite cannot change the foreign keys of an existing table. Items of
+    categories that no longer exist are deleted first, since they would not
+    satisfy the foreign key.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    keys = engine.execute("PRAGMA foreign_key_list(item)").fetchall()
+    if any(key["table"] == "category" and key["on_delete"] == "CASCADE"
+           for key in keys):
+        return
+
+    table = Item.__table__
+    columns = ", ".join(column.name for column in table.columns)
+    ddl = str(CreateTable(table).compile(dialect=engine.dialect))
+
+    with engine.begin() as connection:
+        connection.execute(
+            "DELETE FROM item WHERE category_id IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM category WHERE category.id = item.category_id)")
+        connection.execute("DROP TABLE IF EXISTS item_new")
+        connection.execute(ddl.replace("CREATE TABLE item ",
+                                       "CREATE TABLE item_new ", 1))
+        connection.execute("INSERT INTO item_new (%s) SELECT %s FROM item" %
+                           (columns, columns))
+        # Dropping the table also drops its indexes and search triggers, and
+        # leaves the search index, which is keyed by item id, as it is
+        connection.execute("DROP TABLE item")
+        connection.execute("ALTER TABLE item_new RENAME TO item")
+        for index in table.indexes:
+            index.create(connection)
+        if has_search_index(connection):
+            for statement in SEARCH_INDEX_DDL:
+                if statement.startswith("CREATE TRIGGER"):
+                    connection.execute(statement)
+    print("Added ON DELETE CASCADE to item.category_id")
+
+
+def create_missing_search_index(engine):
+    """ Creates the full-text index, if supported, and indexes every item """
+    with engine.begin() as connection:
+        if has_search_index(connection) or \
+                not supports_search_index(connection):
+            return
+        rebuild_search_index(connection)
+        print("Created and populated the search index")
+
+
+def recompute_category_stats(engine):
+    """
+    Fills in Category.item_count and last_item_at. Cheap next to the other
+    steps, so it is simply run every time.
+    """
+    with engine.begin() as connection:
+        repair_category_stats(connection)
+
+
+# Applied in order
+MIGRATIONS = [
+    create_missing_tables,
+    add_missing_columns,
+    create_missing_indexes,
+    add_item_category_cascade,
+    create_missing_search_index,
+    recompute_category_stats,
+]
+
+
+def migrate(engine):
+    """ Applies every migration step to the database behind engine """
+    for step in MIGRATIONS:
+        step(engine)
+
+
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else DATABASE_URL
+    migrate(create_db_engine(url))
+    print("Database is up to date")
@@ -0,0 +1,160 @@
+"""
+Clients for the Google and Facebook APIs used by the login handlers
+
+Each client keeps a requests.Session whose connection pool is reused across
+logins, so calls after the first skip the TCP and TLS handshakes. Every call
+has a timeout, and idempotent calls are retried on connection errors and
+gateway failures. Base URLs can be overridden to point the clients at the
+fake server in fake_provider.py.
+
+Calls that do not have to finish before responding, such as revoking a token
+on logout, are queued as jobs and made by worker.py instead.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+class ProviderError(Exception):
+
+    """ Raised when a provider returns an error or cannot be reached """
+
+    pass
+
+
+class ProviderClient(object):
+
+    """ Base class holding the pooled session shared by a provider's calls """
+
+    def __init__(self, base_url, timeout=5.0, retries=2, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(total=retries, backoff_factor=0.1,
+                      status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """ Makes a request relative to base_url and returns the response """
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            return self.session.request(method, self.base_url + path,
+                                        **kwargs)
+        except requests.RequestException as e:
+            raise ProviderError(str(e))
+
+    def get_json(self, path, **kwargs):
+        """ Makes a GET request and returns the decoded JSON body """
+        try:
+            return self.request("GET", path, **kwargs).json()
+        except ValueError:
+            raise ProviderError("Invalid JSON returned for %s" % path)
+
+
+class GoogleClient(ProviderClient):
+
+    """ Google OAuth2 token and user info endpoints """
+
+    def __init__(self, base_url="https://www.googleapis.com",
+                 accounts_url="https://accounts.google.com", **kwargs):
+        ProviderClient.__init__(self, base_url, **kwargs)
+        self.accounts_url = accounts_url.rstrip("/")
+
+    def token_info(self, access_token):
+        return self.get_json("/oauth2/v1/tokeninfo",
+                             params=dict(access_token=access_token))
+
+    def user_info(self, access_token):
+        return self.get_json("/oauth2/v1/userinfo",
+                             params=dict(access_token=access_token,
+                                         alt="json"))
+
+    def revoke(self, access_token):
+        """
+        Revokes a token. An invalid token is ignored since that usually
+        means the user is already logged out.
+        """
+        try:
+            response = self.session.get(
+                self.accounts_url + "/o/oauth2/revoke",
+                params=dict(token=access_token), timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ProviderError(str(e))
+
+        if response.status_code != 200:
+            try:
+                error = response.json().get("error")
+            except ValueError:
+                error = None
+            if error != "invalid_token":
+                raise ProviderError("Failed to revoke token: %s" %
+                                    response.text)
+
+
+class FacebookClient(ProviderClient):
+
+    """ Facebook Graph API calls used for login and logout """
+
+    def __init__(self, base_url="https://graph.facebook.com", workers=4,
+                 **kwargs):
+        ProviderClient.__init__(self, base_url, **kwargs)
+        self.pool = ThreadPool(workers)
+
+    def exchange_token(self, app_id, app_secret, access_token):
+        """ Exchanges a short-lived client token for a long-lived one """
+        response = self.request("GET", "/oauth/access_token",
+                                params=dict(grant_type="fb_exchange_token",
+                                            client_id=app_id,
+                                            client_secret=app_secret,
+                                            fb_exchange_token=access_token))
+        token = parse_query_string(response.text).get("access_token")
+        if token is None:
+            raise ProviderError("Token exchange failed: %s" % response.text)
+        return token
+
+    def profile(self, token):
+        """
+        Returns the user's (name, id, email) data and picture URL. The two
+        are independent, so they are fetched concurrently.
+        """
+        picture = self.pool.apply_async(
+            self.get_json, ("/v2.5/me/picture",),
+            dict(params=dict(redirect=0, height=200, width=200,
+                             access_token=token)))
+        data = self.get_json("/v2.5/me", params=dict(access_token=token,
+                                                     fields="name,id,email"))
+        return data, picture.get()["data"]["url"]
+
+    def revoke(self, facebook_id, access_token):
+        response = self.request("DELETE", "/%s/permissions" % facebook_id,
+                                params=dict(access_token=access_token))
+        if response.status_code != 200:
+            raise ProviderError("Failed to revoke token: %s" % response.text)
+
+
+def parse_query_string(query_string):
+    """
+    Returns a dictionary of query string parameters
+
+    Used for parsing results from certain Facebook APIs that return results in
+    a query string format.
+    """
+
+    parameters = query_string.split("&")
+    result = {}
+
+    for parameter in parameters:
+        parameter_parts = parameter.split("=", 1)
+        if len(parameter_parts) != 2:
+            continue
+
+        result[parameter_parts[0]] = parameter_parts[1]
+
+    return result
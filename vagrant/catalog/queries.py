@@ -0,0 +1,129 @@
+"""
+Query builders for the catalog pages
+
+Each helper returns a query that loads everything its page template touches,
+so rendering a page never falls back to lazy loading relationships one row at
+a time.
+
+Large categories are deleted by setting Category.deleted_at, after which a
+background job purges them and their items. Every query here hides them in
+the meantime, and items are always inner joined to a live category.
+"""
+
+import threading
+
+from sqlalchemy import desc, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, contains_eager
+
+from database_setup import Category, Item
+
+
+def live_categories(session):
+    """ Categories that have not been deleted """
+    return session.query(Category).filter(Category.deleted_at.is_(None))
+
+
+def live_items(session):
+    """ Items of categories that have not been deleted """
+    return (session.query(Item).join(Item.category)
+            .filter(Category.deleted_at.is_(None)))
+
+
+def all_categories(session):
+    """ All categories, newest first """
+    return live_categories(session).order_by(desc(Category.id))
+
+
+def latest_items(session, limit=10):
+    """ The newest items with their categories loaded in the same query """
+    return (live_items(session).options(contains_eager(Item.category))
+            .order_by(desc(Item.id))
+            .limit(limit))
+
+
+def category_by_id(session, category_id):
+    """ A single category with the user who created it """
+    return (live_categories(session)
+            .options(joinedload(Category.user))
+            .filter_by(id=category_id))
+
+
+def category_items(session, category_id):
+    """ Items in a category. Only the item columns are loaded """
+    return session.query(Item).filter_by(category_id=category_id)
+
+
+def item_by_id(session, item_id):
+    """ A single item with its category and the user who created it """
+    return (live_items(session).options(contains_eager(Item.category))
+            .options(joinedload(Item.user))
+            .filter(Item.id == item_id))
+
+
+def keyset_page(query, column, after_id, limit):
+    """
+    Restricts query to the next page of rows ordered by column, starting after
+    the row whose column value is after_id. Unlike OFFSET, the cost of a page
+    does not grow with how far into the results it is.
+    """
+    return query.filter(column > after_id).order_by(column).limit(limit)
+
+
+def stream(query, batch_size=500):
+    """
+    Iterates over query in batches of batch_size rows, using a server-side
+    cursor where the database supports one, so memory use stays constant
+    """
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+class QueryBudgetExceeded(Exception):
+
+    """ Raised when a page issues more SQL statements than it is allowed """
+
+    pass
+
+
+# The counters entered on each thread. A single listener feeds them, so that
+# entering and leaving a counter never changes the engine's listeners while
+# another thread is running a statement
+active_counters = threading.local()
+
+
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    for counter in getattr(active_counters, "counters", ()):
+        if counter.engine is None or conn.engine is counter.engine:
+            counter.statements.append(statement)
+
+
+event.listen(Engine, "before_cursor_execute", count_statement)
+
+
+class QueryCounter(object):
+
+    """
+    Counts SQL statements executed on an engine, or on every engine when
+    engine is None, by the current thread
+
+    Used as a context manager. Statements run by other threads on the same
+    engine are ignored so concurrent requests do not inflate the count.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(active_counters, "counters"):
+            active_counters.counters = []
+        active_counters.counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active_counters.counters.remove(self)
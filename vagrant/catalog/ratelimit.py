@@ -0,0 +1,180 @@
+"""
+Rate limits for the catalog app
+
+A limiter allows each client, identified by a key such as a user id or an IP
+address, a number of requests per period, given as a rate like "30/60" for
+30 requests per 60 seconds. hit() records a request and returns 0 when it is
+allowed, or the number of seconds to wait before retrying.
+
+Two interchangeable limiters are provided, like the caches in cache.py.
+TokenBucketLimiter lives inside a single process and keeps a bucket of up to
+limit tokens per client, refilled at limit / period tokens a second, so a
+client may burst up to limit requests and then continue at the steady rate.
+It tracks at most max_keys clients, forgetting the least recently seen.
+
+SlidingWindowLimiter keeps its counts in memcached, so that every worker
+enforces one limit per client. As memcached only offers atomic increments, it
+counts requests in fixed windows of period seconds and weighs the previous
+window's count by how much of it still overlaps the last period. Requests it
+refuses are counted too, so a client retrying in a loop stays limited.
+
+Use create_limiter() to build one from a URL.
+"""
+
+import math
+import threading
+import time
+
+from collections import OrderedDict
+
+from cache import create_cache
+
+
+def parse_rate(rate):
+    """ Returns (limit, period) from a rate such as "30/60" """
+    try:
+        limit, period = rate.split("/")
+        limit, period = int(limit), float(period)
+    except ValueError:
+        raise ValueError("Invalid rate, expected limit/seconds: %r" % rate)
+    if limit < 1 or period <= 0:
+        raise ValueError("Invalid rate, expected limit/seconds: %r" % rate)
+    return limit, period
+
+
+def retry_after(wait):
+    """ Rounds a wait up to whole seconds, as used by Retry-After """
+    return int(math.ceil(wait))
+
+
+class TokenBucketLimiter(object):
+
+    """ A thread-safe token bucket per key, for at most max_keys keys """
+
+    def __init__(self, limit, period, max_keys=10000):
+        self.limit = limit
+        self.period = period
+        self.rate = limit / float(period)
+        self.max_keys = max_keys
+        # Per key: (tokens left, time they were counted)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+
+    def hit(self, key):
+        """ Takes a token for key. Returns 0, or seconds until one is due """
+        now = time.time()
+        with self.lock:
+            tokens, counted = self.buckets.pop(key, (self.limit, now))
+            tokens = min(self.limit, tokens + (now - counted) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+
+            # Re-insert to mark the key as most recently seen
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+        return wait
+
+    def reset(self):
+        """ Forgets every key, giving each a full bucket """
+        with self.lock:
+            self.buckets.clear()
+
+    def stats(self):
+        """ Returns the number of keys tracked and allowed/limited counters """
+        with self.lock:
+            return {
+                "keys": len(self.buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "evictions": self.evictions,
+            }
+
+
+class SlidingWindowLimiter(object):
+
+    """
+    Counts requests per key in a MemcachedCache shared with other processes.
+    Requests are allowed when the cache cannot be reached, so that a
+    memcached outage never takes the site down with it.
+    """
+
+    def __init__(self, cache, limit, period):
+        self.cache = cache
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def hit(self, key):
+        """ Counts a request for key. Returns 0, or the seconds to wait """
+        now = time.time()
+        window = int(now // self.period)
+        elapsed = now - window * self.period
+
+        current = self.cache.incr("%s:%d" % (key, window))
+        previous = self.cache.incr("%s:%d" % (key, window - 1), 0)
+        if current is None or previous is None:
+            wait = 0
+        elif previous * (1 - elapsed / self.period) + current <= self.limit:
+            wait = 0
+        elif current <= self.limit:
+            # Until enough of the previous window has slid out of the period
+            wait = (1 - (self.limit - current) / float(previous)) * \
+                self.period - elapsed
+        else:
+            # Until this window, once it is the previous one, is weighed low
+            # enough
+            wait = self.period - elapsed + \
+                (1 - self.limit / float(current)) * self.period
+
+        with self.lock:
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return max(wait, 0)
+
+    def reset(self):
+        """ Nothing to do: counts expire on their own after two periods """
+        pass
+
+    def stats(self):
+        """ Returns this process's allowed/limited counters """
+        with self.lock:
+            return {
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "errors": self.cache.stats()["errors"],
+            }
+
+
+def create_limiter(url, rate, prefix="", max_keys=10000):
+    """
+    Builds a limiter for rate from a URL. "memory://" gives a
+    TokenBucketLimiter private to this process and "memcached://host:port" a
+    SlidingWindowLimiter shared by every worker using the same server.
+    """
+    limit, period = parse_rate(rate)
+    if url == "memory://":
+        return TokenBucketLimiter(limit, period, max_keys=max_keys)
+
+    if url.startswith("memcached://"):
+        # Counts are needed for the current and the previous window
+        ttl = int(math.ceil(2 * period)) + 1
+        return SlidingWindowLimiter(create_cache(url, ttl=ttl, prefix=prefix),
+                                    limit, period)
+
+    raise ValueError("Unsupported rate limit URL: %s" % url)
@@ -0,0 +1,27 @@
+"""
+Routing of reads to a replica database
+
+RoutingSession sends the statements of a session to the engine in its
+info["replica"] unless info["use_primary"] is set, in which case, like
+every flush, they go to the primary engine the session is bound to. The
+app sets use_primary for requests that may write, and for a while after a
+user's own writes, so that users always see their changes even when the
+replica lags behind.
+
+How the replica is kept up to date is up to the database: PostgreSQL
+streaming replication, or for local testing any copy of a SQLite file.
+"""
+
+from sqlalchemy.orm import Session
+
+
+class RoutingSession(Session):
+
+    """ A session reading from a replica and writing to the primary """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get("replica")
+        if replica is None or self.info.get("use_primary") or \
+                self._flushing:
+            return Session.get_bind(self, mapper, clause)
+        return replica
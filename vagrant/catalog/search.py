@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Full-text search over item names and descriptions
+
+Searches use the item_search FTS5 index created in database_setup.py and rank
+results with bm25. Databases built with an SQLite that lacks FTS5 fall back to
+a much slower LIKE scan so search still works.
+
+Usage: python search.py rebuild [database url]
+    Rebuilds the index from the item table, creating it first if needed.
+"""
+
+import re
+import sys
+
+from sqlalchemy import (Table, Column, Integer, MetaData, func, or_, desc,
+                        literal_column)
+from sqlalchemy.orm import contains_eager
+
+from database_setup import (DATABASE_URL, Item, create_db_engine,
+                            create_search_index, has_search_index,
+                            supports_search_index)
+from queries import live_items
+
+# The index as seen by queries. It has its own metadata so create_all() does
+# not try to create it as a regular table
+item_search = Table("item_search", MetaData(),
+                    Column("rowid", Integer),
+                    Column("item_search"))
+
+# Whether each engine has the index, checked once per engine
+index_available = {}
+
+
+def like_pattern(term):
+    """
+    A LIKE pattern matching term anywhere, with the LIKE wildcards in term
+    escaped by a backslash
+    """
+    for character in "\\%_":
+        term = term.replace(character, "\\" + character)
+    return "%" + term + "%"
+
+
+def search_terms(text):
+    """ Splits search text into words, dropping FTS5 operators and quotes """
+    return re.findall(r"\w+", text, re.UNICODE)
+
+
+def search_items(session, text):
+    """
+    Returns a query of the items matching every word in text, best match
+    first, with their categories loaded
+    """
+    terms = search_terms(text)
+    query = live_items(session).options(contains_eager(Item.category))
+    if not terms:
+        return query.filter(Item.id.is_(None))
+
+    engine = session.get_bind()
+    if engine not in index_available:
+        index_available[engine] = has_search_index(session.connection())
+
+    if index_available[engine]:
+        expression = " ".join('"%s"' % term for term in terms)
+        return (query.join(item_search, item_search.c.rowid == Item.id)
+                .filter(item_search.c.item_search.match(expression))
+                .order_by(func.bm25(literal_column("item_search")), Item.id))
+
+    for term in terms:
+        pattern = like_pattern(term)
+        query = query.filter(or_(Item.name.like(pattern, escape="\\"),
+                                 Item.description.like(pattern, escape="\\")))
+    return query.order_by(desc(Item.id))
+
+
+def rebuild_search_index(connection):
+    """ Creates the index if needed and re-indexes every item """
+    create_search_index(None, connection)
+    connection.execute("INSERT INTO item_search (item_search) "
+                       "VALUES ('rebuild')")
+    connection.execute("INSERT INTO item_search (item_search) "
+                       "VALUES ('optimize')")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        sys.exit(__doc__)
+
+    url = sys.argv[2] if len(sys.argv) > 2 else DATABASE_URL
+    with create_db_engine(url).begin() as connection:
+        if not supports_search_index(connection):
+            sys.exit("This SQLite build does not support FTS5")
+        rebuild_search_index(connection)
+    print("Search index rebuilt")
@@ -0,0 +1,154 @@
+"""
+Server-side sessions for the catalog app
+
+Session data is kept in the web_session table instead of being serialized
+and signed into the cookie on every response. The cookie only carries a
+random session id. Records are also kept in a cache, so most requests read
+their session without touching the database, and are only written when the
+session changes or is close to expiring.
+
+Visitors whose session stays empty, as for most anonymous page views, get
+no record and no cookie. Expired records are deleted by worker.py.
+"""
+
+import binascii
+import os
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from flask.sessions import session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+from database_setup import WebSession
+
+web_session = WebSession.__table__
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    """ A session dict that tracks changes and knows its id """
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotated = False
+
+    def rotate(self):
+        """
+        Moves the session to a new id, e.g. on login, so that an id known to
+        someone else before the login does not grant access after it
+        """
+        self.rotated = True
+        self.modified = True
+
+
+def new_session_id():
+    return binascii.hexlify(os.urandom(32))
+
+
+def delete_expired_sessions(session):
+    """ Deletes every expired session record. Returns the number deleted """
+    return session.execute(web_session.delete().where(
+        web_session.c.expires_at < time.time())).rowcount
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    """
+    Stores sessions in the database through get_engine(), a function that
+    returns the engine to use, with cache in front of it. A shared cache
+    keeps every server process up to date with the others' changes.
+    """
+
+    def __init__(self, get_engine, cache):
+        self.get_engine = get_engine
+        self.cache = cache
+
+    def load(self, sid):
+        """ Returns the (data, expires_at) of a session, or None """
+        record = self.cache.get(sid)
+        if record is None:
+            row = self.get_engine().execute(
+                web_session.select().where(web_session.c.id == sid)).first()
+            if row is None:
+                return None
+            record = (row.data, row.expires_at)
+            self.cache.set(sid, record)
+
+        data, expires_at = record
+        if expires_at < time.time():
+            return None
+        return session_json_serializer.loads(data), expires_at
+
+    def store(self, sid, data, expires_at):
+        """ Creates or replaces a session record """
+        data = session_json_serializer.dumps(data)
+        with self.get_engine().begin() as connection:
+            updated = connection.execute(
+                web_session.update().where(web_session.c.id == sid)
+                .values(data=data, expires_at=expires_at)).rowcount
+            if not updated:
+                connection.execute(web_session.insert().values(
+                    id=sid, data=data, expires_at=expires_at))
+        self.cache.set(sid, (data, expires_at))
+
+    def delete(self, sid):
+        self.get_engine().execute(
+            web_session.delete().where(web_session.c.id == sid))
+        self.cache.delete(sid)
+
+    def create(self, app, data):
+        """ Stores a new session holding data and returns its id """
+        sid = new_session_id()
+        self.store(sid, data, self.record_expiration(app))
+        return sid
+
+    def record_expiration(self, app):
+        return time.time() + app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            record = self.load(sid)
+            if record is not None:
+                data, expires_at = record
+                return ServerSideSession(data, sid, expires_at)
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.sid is not None and not session.modified:
+            # Only extend a session once half of its lifetime has passed,
+            # rather than writing it on every request
+            if session.expires_at - time.time() > lifetime / 2:
+                return
+        elif session.rotated and session.sid is not None:
+            self.delete(session.sid)
+            session.sid = None
+
+        new = session.sid is None
+        if new:
+            session.sid = new_session_id()
+        self.store(session.sid, dict(session), self.record_expiration(app))
+
+        if new or session.permanent:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app,
+                                                                 session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
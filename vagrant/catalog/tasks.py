@@ -0,0 +1,62 @@
+"""
+Background tasks run by worker.py
+
+Each task is queued from app.py with jobs.enqueue() and receives a database
+session followed by the arguments it was queued with.
+"""
+
+import logging
+
+import avatars
+from database_setup import User, Category, Item
+from jobs import task
+from providers import GoogleClient, FacebookClient
+
+log = logging.getLogger(__name__)
+
+google = GoogleClient()
+facebook = FacebookClient()
+
+
+@task
+def revoke_google_token(session, access_token):
+    """ Revokes a Google token after its user logged out """
+    google.revoke(access_token)
+
+
+@task
+def revoke_facebook_token(session, facebook_id, access_token):
+    """ Revokes a Facebook token after its user logged out """
+    facebook.revoke(facebook_id, access_token)
+
+
+@task
+def cache_avatar(session, user_id):
+    """ Downloads a user's picture and stores its thumbnails """
+    if not avatars.available():
+        log.warning("Pillow is not installed, avatars are not cached")
+        return
+
+    user = session.query(User).filter_by(id=user_id).one()
+    if user.picture:
+        user.avatar = avatars.store.save(avatars.download(user.picture))
+
+
+@task
+def purge_category(session, category_id, batch_size=1000):
+    """
+    Deletes a category hidden by setting deleted_at, and its items. Items
+    are deleted batch_size at a time, each batch in its own transaction, so
+    other writers never wait for more than one batch.
+    """
+    while True:
+        item_ids = [item_id for (item_id,) in
+                    session.query(Item.id).filter_by(category_id=category_id)
+                    .limit(batch_size)]
+        if not item_ids:
+            break
+        (session.query(Item).filter(Item.id.in_(item_ids))
+         .delete(synchronize_session=False))
+        session.commit()
+
+    session.query(Category).filter_by(id=category_id).delete()
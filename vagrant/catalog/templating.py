@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Template compilation and fragment caching for the catalog app
+
+Jinja compiles each template to Python the first time it is used, in every
+server process. configure_templates() gives the app a bytecode cache on disk
+so a new process loads compiled templates instead, and compile_templates()
+fills that cache ahead of time, e.g. when deploying.
+
+It also adds a {% cache %} tag that renders its body once per key and
+reuses the output afterwards:
+
+    {% cache "top_bar", g.logged_in %}...{% endcache %}
+
+Only wrap parts of a page that depend on nothing but the key.
+
+Usage: python templating.py compile
+    Compiles every template into the bytecode cache.
+"""
+
+import os
+import sys
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from cache import LRUCache
+
+# Relative to this directory, whatever the current directory is
+TEMPLATE_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.environ.get("CATALOG_TEMPLATE_CACHE_DIR", "template_cache"))
+
+
+class FragmentCacheExtension(Extension):
+
+    """ Adds the {% cache key, ... %}...{% endcache %} tag """
+
+    tags = set(["cache"])
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        # Fragments never expire, as they only change with the templates
+        environment.extend(fragment_cache=LRUCache(max_entries=1000,
+                                                   ttl=None))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("render_fragment", [nodes.List(parts)]),
+            [], [], body).set_lineno(lineno)
+
+    def render_fragment(self, parts, caller):
+        key = ":".join(str(part) for part in parts)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            self.environment.fragment_cache.set(key, fragment)
+        return fragment
+
+
+def configure_templates(app, cache_dir=TEMPLATE_CACHE_DIR):
+    """ Adds the bytecode cache and the {% cache %} tag to app's templates """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+def compile_templates(app):
+    """ Loads every template, storing its bytecode. Returns their names """
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "compile":
+        sys.exit(__doc__)
+
+    from app import app
+    names = compile_templates(app)
+    print("Compiled %d templates into %s" % (len(names), TEMPLATE_CACHE_DIR))
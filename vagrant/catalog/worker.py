@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Runs the background jobs queued by the catalog app, deletes expired
+sessions once a minute and finished jobs once an hour
+
+Usage:
+  python worker.py [--threads 4] [--once] [--database url]
+  python worker.py --stats
+"""
+
+import argparse
+import logging
+
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import DATABASE_URL, create_db_engine
+from jobs import Worker, delete_finished_jobs, job_stats
+from sessions import delete_expired_sessions
+# Registers the tasks that jobs refer to
+import tasks
+
+
+def print_stats(engine):
+    """ Prints job counts and latencies per task and status """
+    session = sessionmaker(bind=engine)()
+    print("%-25s %-8s %8s %10s %10s %10s %10s" %
+          ("task", "status", "count", "avg wait", "max wait", "avg run",
+           "max run"))
+    for row in job_stats(session):
+        latencies = tuple("%.3fs" % row[key] if row[key] is not None else "-"
+                          for key in ("avg_wait", "max_wait", "avg_run",
+                                      "max_run"))
+        print("%-25s %-8s %8d %10s %10s %10s %10s" %
+              ((row["name"], row["status"], row["count"]) + latencies))
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs background jobs")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--once", action="store_true",
+                        help="run the jobs that are due, then exit")
+    parser.add_argument("--stats", action="store_true",
+                        help="print job counts and latencies, then exit")
+    parser.add_argument("--database", default=DATABASE_URL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = create_db_engine(args.database)
+
+    if args.stats:
+        print_stats(engine)
+        return
+
+    worker = Worker(engine, threads=args.threads)
+    worker.every(60, delete_expired_sessions)
+    worker.every(3600, delete_finished_jobs)
+    if args.once:
+        print("Ran %d jobs" % worker.run_pending())
+    else:
+        worker.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 apt-get -qqy update
 apt-get -qqy install postgresql python-psycopg2
-apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
+apt-get -qqy install libpq-dev python-dev
+pip install 'psycopg2>=2.8,<2.9'
+# The catalog needs newer versions than the python-flask and
+# python-sqlalchemy packages of the distribution
+pip install 'SQLAlchemy>=1.3,<1.4'
+pip install 'Werkzeug>=1.0,<2' 'Flask>=1.1,<2'
+pip install 'networkx<2.3'
 pip install bleach
 pip install oauth2client
 pip install requests
@@ -10,6 +16,7 @@ pip install redis
 pip install passlib
 pip install itsdangerous
 pip install flask-httpauth
+pip install Pillow
 su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb forum'
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for tournament.py
+
+Registers a field of players and reports a round of matches for it, first
+one call per player and per match with registerPlayer() and reportMatch(),
+then in batches with registerPlayers() and reportMatches(). Each run uses a
+new tournament, deleted afterwards, so existing tournaments are not touched.
+
+Rows per second are printed for every method, along with the speedup of the
+batched methods.
+
+It then plays --rounds rounds of a tournament of --field players and times
+pairing the next round with swissPairings() against reading the old
+swiss_pairings view, which ignores rematches and byes.
+
+Usage: python benchmark.py [--players 512] [--field 10000] [--rounds 5]
+                           [--database tournament]
+"""
+
+import argparse
+import random
+import time
+
+from tournament import Tournament
+
+
+def timed(f, *args):
+    """ Returns the result of f(*args) and the seconds it took """
+    started = time.time()
+    result = f(*args)
+    return result, time.time() - started
+
+
+def register_one_by_one(t, names):
+    for name in names:
+        t.registerPlayer(name)
+    return [row[0] for row in t.playerStandings()]
+
+
+def report_one_by_one(t, results):
+    for (winner, loser) in results:
+        t.reportMatch(winner, loser)
+
+
+def run(dbname, players, batched):
+    """ Returns the seconds taken to register players and report a round """
+    t = Tournament.create("Benchmark", dbname)
+    try:
+        names = ["Player %d" % i for i in range(players)]
+        if batched:
+            ids, register_time = timed(t.registerPlayers, names)
+        else:
+            ids, register_time = timed(register_one_by_one, t, names)
+
+        results = zip(ids[0::2], ids[1::2])
+        if batched:
+            _, report_time = timed(t.reportMatches, results)
+        else:
+            _, report_time = timed(report_one_by_one, t, results)
+    finally:
+        t.deleteTournament()
+        t.close()
+    return register_time, report_time
+
+
+def play_rounds(t, players, rounds):
+    """ Registers players and plays rounds, each won by a random player """
+    t.registerPlayers(["Player %d" % i for i in range(players)])
+    for _ in range(rounds):
+        pairings = t.swissPairings()
+        if pairings and pairings[-1][2] is None:
+            t.reportBye(pairings.pop()[0])
+        t.reportMatches(random.choice([(id1, id2), (id2, id1)])
+                        for (id1, name1, id2, name2) in pairings)
+
+
+def sql_pairings(t):
+    with t.transaction() as cur:
+        cur.execute("SELECT id1, name1, id2, name2 FROM swiss_pairings "
+                    "WHERE tournament_id = %s", (t.tournament_id,))
+        result = cur.fetchall()
+    return result
+
+
+def run_pairings(dbname, players, rounds, repeat=5):
+    """ Returns the best seconds taken to pair in Python and in SQL """
+    t = Tournament.create("Pairing benchmark", dbname)
+    try:
+        play_rounds(t, players, rounds)
+        python_time = min(timed(t.swissPairings)[1] for _ in range(repeat))
+        sql_time = min(timed(sql_pairings, t)[1] for _ in range(repeat))
+    finally:
+        t.deleteTournament()
+        t.close()
+    return python_time, sql_time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares per-call and batched tournament writes, and "
+        "Python and SQL pairings")
+    parser.add_argument("--players", type=int, default=512)
+    parser.add_argument("--field", type=int, default=10000,
+                        help="players in the pairing benchmark")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="rounds played before pairing")
+    parser.add_argument("--database", default="tournament")
+    args = parser.parse_args()
+
+    matches = args.players // 2
+    single = run(args.database, args.players, batched=False)
+    batch = run(args.database, args.players, batched=True)
+
+    print("%-16s %10s %10s %8s" % ("", "per call/s", "batched/s", "speedup"))
+    for label, rows, single_time, batch_time in (
+            ("register players", args.players, single[0], batch[0]),
+            ("report matches", matches, single[1], batch[1])):
+        print("%-16s %10.0f %10.0f %7.1fx" % (
+            label, rows / single_time, rows / batch_time,
+            single_time / batch_time))
+
+    python_time, sql_time = run_pairings(args.database, args.field,
+                                         args.rounds)
+    print("\nPairing %d players after %d rounds:" % (args.field, args.rounds))
+    print("  swissPairings()      %8.1f ms" % (python_time * 1000))
+    print("  swiss_pairings view  %8.1f ms" % (sql_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
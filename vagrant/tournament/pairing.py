@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# pairing.py -- Swiss pairings without rematches
+#
+
+from itertools import groupby
+from operator import itemgetter
+
+import networkx as nx
+
+# Players with as many wins are paired a window of at most this many at a
+# time, in order of the standings, so that every matching stays small
+# however large the field
+WINDOW = 16
+
+# Players left over at the end of a score group are matched again along with
+# at most this many players of the group's last pairs
+REMATCH = 2 * WINDOW
+
+
+class PairingError(Exception):
+    """Raised when the players cannot all be paired without a rematch."""
+    pass
+
+
+def chooseBye(standings, byes):
+    """Returns the player to sit out a round with an odd number of players.
+
+    That is the lowest ranked of the players who have had the fewest byes,
+    so nobody gets a second bye before everyone has had one.
+
+    Args:
+      standings: a list of (id, wins) tuples, best player first.
+      byes: a dict of the number of byes each player has had.
+    """
+    fewest = min(byes.get(player, 0) for (player, wins) in standings)
+    for (player, wins) in reversed(standings):
+        if byes.get(player, 0) == fewest:
+            return player
+
+
+def cost(window, pairs):
+    """The sum of the squared differences in wins of pairs of window."""
+    wins = dict(window)
+    return sum((wins[a] - wins[b]) ** 2 for (a, b) in pairs)
+
+
+def greedyPairs(window, played):
+    """Pairs the players of window without rematches, if it is cheap to.
+
+    Each player in turn is paired with the next unpaired player below them
+    that they have not played yet, which is neighbours in the standings
+    whenever there is no rematch. Players who have played everyone below
+    them are left unpaired.
+
+    Returns:
+      A list of (id1, id2) pairs and a list of the players left unpaired,
+      or None if pairing the same players as neighbours would have given
+      smaller differences in wins.
+    """
+    left = list(window)
+    pairs = []
+    unpaired = []
+    while left:
+        (player, wins) = left.pop(0)
+        for (i, (opponent, _)) in enumerate(left):
+            if frozenset((player, opponent)) not in played:
+                pairs.append((player, opponent))
+                del left[i]
+                break
+        else:
+            unpaired.append((player, wins))
+
+    paired = [row for row in window if row not in unpaired]
+    neighbours = [(paired[i][0], paired[i + 1][0])
+                  for i in range(0, len(paired) - 1, 2)]
+    if cost(window, pairs) > cost(window, neighbours):
+        return None
+    return pairs, unpaired
+
+
+def matchWindow(window, played):
+    """Pairs as many players of window as possible without rematches.
+
+    Uses a maximum weight matching (Edmonds' blossom algorithm) in which
+    pairing two players costs the square of their difference in wins,
+    then their distance in the standings. Among the pairings of the most
+    players, the one with the lowest total cost is chosen.
+
+    Returns:
+      A list of (id1, id2) pairs, best players first, and a list of the
+      players of window left unpaired, in order.
+    """
+    size = len(window)
+    largest = size * size * (max(wins for (player, wins) in window) -
+                             min(wins for (player, wins) in window) + 1) ** 2
+    graph = nx.Graph()
+    graph.add_nodes_from(range(size))
+    for a in range(size):
+        for b in range(a + 1, size):
+            if frozenset((window[a][0], window[b][0])) in played:
+                continue
+            penalty = (window[a][1] - window[b][1]) ** 2 * size * size + \
+                b - a
+            graph.add_edge(a, b, weight=largest - penalty)
+
+    matching = nx.max_weight_matching(graph, maxcardinality=True)
+    paired = set()
+    pairs = []
+    for (a, b) in sorted(tuple(sorted(edge)) for edge in matching):
+        pairs.append((window[a][0], window[b][0]))
+        paired.update((a, b))
+    unpaired = [window[i] for i in range(size) if i not in paired]
+    return pairs, unpaired
+
+
+def rematch(pairs, start, left, rank, wins, played):
+    """Pairs players left over at the end of a score group, if possible.
+
+    The last pairs made since pairs[start] are undone and matched again
+    along with the players left over, in ever larger groups of up to
+    REMATCH players, until everyone is paired. Pairs are replaced in place.
+
+    Returns:
+      The players still left over, as (id, wins) tuples.
+    """
+    undo = 0
+    while left and undo < len(pairs) - start and 2 * undo < REMATCH:
+        undo = min(max(undo * 2, 1), len(pairs) - start)
+        group = [player for pair in pairs[-undo:] for player in pair]
+        group = sorted(group + [player for (player, w) in left],
+                       key=rank.get)
+        matched, rest = matchWindow([(p, wins[p]) for p in group], played)
+        if len(rest) < len(left):
+            pairs[-undo:] = matched
+            left = rest
+    return left
+
+
+def swissPairings(standings, played, byes=None):
+    """Pairs players with equal or nearly equal wins, without rematches.
+
+    Players are grouped by wins, and each group is taken from the top a
+    window at a time. A window is paired by greedyPairs() when that is
+    optimal, and otherwise by matchWindow(). Players left over move down to
+    the next window. Those left over by the last window of a group are
+    matched again with the group's last pairs by rematch(), and only move
+    down to the next group if they still cannot be paired.
+    If the last players cannot be paired, the pairs before them are undone
+    and matched again along with them, in ever larger groups.
+
+    Args:
+      standings: a list of (id, wins) tuples, best player first.
+      played: a set of frozensets of the ids of players who have met.
+      byes: a dict of the number of byes each player has had, used to pick
+        the player to sit out when the number of players is odd.
+
+    Returns:
+      A list of (id1, id2) pairs, best players first, and the id of the
+      player with a bye, or None.
+
+    Raises:
+      PairingError: there is no pairing without a rematch.
+    """
+    standings = list(standings)
+    bye = None
+    if len(standings) % 2:
+        bye = chooseBye(standings, byes or {})
+        standings = [row for row in standings if row[0] != bye]
+
+    rank = dict((row[0], i) for (i, row) in enumerate(standings))
+    wins = dict(standings)
+    pairs = []
+    pending = []
+    for (score, group) in groupby(standings, itemgetter(1)):
+        group = list(group)
+        start = len(pairs)
+        position = 0
+        while position < len(group):
+            taken = max(WINDOW - len(pending), 2)
+            window = pending + group[position:position + taken]
+            position += taken
+            # An odd player out waits for the next window, or moves down to
+            # the next score group
+            held = [window.pop()] if len(window) % 2 else []
+
+            # Players left over by greedyPairs() can be paired in the next
+            # window of the group at no cost, but should not move down to
+            # another group when the whole window could be paired
+            greedy = greedyPairs(window, played)
+            last = position >= len(group)
+            if greedy is not None and not (last and greedy[1]):
+                pairs.extend(greedy[0])
+                pending = greedy[1] + held
+            else:
+                matched, left = matchWindow(window, played)
+                pairs.extend(matched)
+                pending = left + held
+
+        # Nobody moves down who could be paired within the group, by
+        # pairing them with players of earlier windows
+        if len(pending) > len(held):
+            left = pending[:len(pending) - len(held)]
+            pending = rematch(pairs, start, left, rank, wins, played) + held
+
+    # Undo the last pairs until the players left over can be paired too
+    undo = 0
+    while pending:
+        if undo == len(pairs):
+            raise PairingError("%d players cannot be paired without a "
+                               "rematch" % len(pending))
+        undo = min(max(undo * 2, 1), len(pairs))
+        group = [player for pair in pairs[-undo:] for player in pair]
+        group = sorted(group + [player for (player, w) in pending],
+                       key=rank.get)
+        matched, left = matchWindow([(p, wins[p]) for p in group], played)
+        if not left:
+            pairs[-undo:] = matched
+            pending = []
+
+    return pairs, bye
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Test cases for pairing.py, which need no database
+
+import random
+
+import pairing
+
+
+def testNeighbours():
+    standings = [(i, 2 if i < 4 else 1) for i in range(8)]
+    pairs, bye = pairing.swissPairings(standings, set())
+    if pairs != [(0, 1), (2, 3), (4, 5), (6, 7)] or bye is not None:
+        raise ValueError("Without rematches, neighbours in the standings "
+                         "should be paired.")
+
+    print "1. Neighbours in the standings are paired."
+
+
+def testNoRematches():
+    standings = [(i, 0) for i in range(6)]
+    played = set([frozenset([0, 1]), frozenset([2, 3]), frozenset([4, 5])])
+    pairs, bye = pairing.swissPairings(standings, played)
+    if len(pairs) != 3 or any(frozenset(pair) in played for pair in pairs):
+        raise ValueError("Players who have met should not be paired again.")
+
+    played = set(frozenset([0, i]) for i in range(1, 4))
+    try:
+        pairing.swissPairings([(i, 0) for i in range(4)], played)
+    except pairing.PairingError:
+        pass
+    else:
+        raise ValueError("PairingError should be raised when every pairing "
+                         "is a rematch.")
+
+    print "2. Players never meet twice."
+
+
+def testFairByes():
+    standings = [(i, 0) for i in range(5)]
+    pairs, bye = pairing.swissPairings(standings, set(), {4: 1, 3: 1})
+    if bye != 2 or len(pairs) != 2:
+        raise ValueError("The lowest ranked player without a bye should sit "
+                         "out.")
+
+    print "3. The bye goes to the lowest ranked player with the fewest byes."
+
+
+def testLargeScoreGroup():
+    # The last window of the 2-win group holds only players 16 and 17, who
+    # have met, but both can be paired with players of the first window
+    standings = [(i, 2) for i in range(18)] + [(18, 1), (19, 1)]
+    played = set([frozenset([16, 17])])
+    pairs, bye = pairing.swissPairings(standings, played)
+    if pairing.cost(standings, pairs) != 0:
+        raise ValueError("Nobody should move down to another score group "
+                         "when their own group can pair everyone.")
+
+    print "4. Players only move down when their score group cannot pair them."
+
+
+def testOptimal():
+    random.seed(1)
+    for trial in range(30):
+        wins = dict((i, 0) for i in range(32))
+        played = set()
+        for round in range(4):
+            standings = sorted(wins.items(), key=lambda row: (-row[1], row[0]))
+            pairs, bye = pairing.swissPairings(standings, played)
+            best, left = pairing.matchWindow(standings, played)
+            if not left and pairing.cost(standings, pairs) > \
+                    pairing.cost(standings, best):
+                raise ValueError("swissPairings should minimize the "
+                                 "differences in wins of the players paired.")
+            for (id1, id2) in pairs:
+                played.add(frozenset([id1, id2]))
+                wins[random.choice([id1, id2])] += 1
+
+    print "5. Pairings are as close in wins as a matching of the whole field."
+
+
+if __name__ == '__main__':
+    testNeighbours()
+    testNoRematches()
+    testFairByes()
+    testLargeScoreGroup()
+    testOptimal()
+    print "Success!  All tests pass!"
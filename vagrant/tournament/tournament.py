@@ -3,52 +3,305 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import sys
+import threading
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
 import psycopg2
+from psycopg2.extensions import TransactionRollbackError
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+import pairing
+
+# Statements keeping player_stats up to date as a match is reported, run in
+# the match's transaction. The rows to change are locked first, in order of
+# player id, so that concurrent reports wait for each other instead of
+# deadlocking.
+LOCK_STATS = """
+SELECT player FROM player_stats
+WHERE player IN (%(winner)s, %(loser)s)
+OR player IN (SELECT player2 FROM matches
+              WHERE tournament_id = %(tournament)s AND player1 = %(winner)s
+              UNION
+              SELECT player1 FROM matches
+              WHERE tournament_id = %(tournament)s AND player2 = %(winner)s)
+ORDER BY player FOR UPDATE
+"""
+
+# Each player now counts the other's wins, as of before this match
+ADD_OPPONENT = """
+UPDATE player_stats SET opponent_wins = player_stats.opponent_wins + o.wins
+FROM player_stats AS o
+WHERE (player_stats.player, o.player) IN ((%(winner)s, %(loser)s),
+                                          (%(loser)s, %(winner)s))
+"""
+
+COUNT_RESULT = """
+UPDATE player_stats SET matches = matches + 1,
+wins = wins + (player = %(winner)s)::INTEGER,
+losses = losses + (player = %(loser)s)::INTEGER
+WHERE player IN (%(winner)s, %(loser)s)
+"""
+
+# A bye counts as a won match
+COUNT_BYE = """
+UPDATE player_stats SET matches = matches + 1, wins = wins + 1
+WHERE player = %(winner)s
+"""
+
+# Every opponent of the winner, this match's loser included, gains a win
+# through it
+COUNT_OPPONENT_WIN = """
+UPDATE player_stats SET opponent_wins = opponent_wins + played.times
+FROM (SELECT opponent, COUNT(*) AS times FROM
+      (SELECT player2 AS opponent FROM matches
+       WHERE tournament_id = %(tournament)s AND player1 = %(winner)s
+       UNION ALL
+       SELECT player1 FROM matches
+       WHERE tournament_id = %(tournament)s AND player2 = %(winner)s)
+      AS opponents
+      GROUP BY opponent) AS played
+WHERE player_stats.player = played.opponent
+"""
+
+# Players of a tournament whose stored stats differ from a full recompute
+WRONG_STATS = """
+SELECT player FROM (
+    (SELECT player, wins, losses, matches, opponent_wins FROM player_stats
+     WHERE tournament_id = %(tournament)s
+     EXCEPT
+     SELECT player, wins, losses, matches, opponent_wins
+     FROM computed_player_stats WHERE tournament_id = %(tournament)s)
+    UNION
+    (SELECT player, wins, losses, matches, opponent_wins
+     FROM computed_player_stats WHERE tournament_id = %(tournament)s
+     EXCEPT
+     SELECT player, wins, losses, matches, opponent_wins FROM player_stats
+     WHERE tournament_id = %(tournament)s)
+) AS wrong GROUP BY player ORDER BY player
+"""
+
+# Stats of a tournament's players recomputed from scratch, updated in place
+# so that the rows stay locked until the rebuild is committed
+REBUILD_STATS = """
+UPDATE player_stats SET wins = computed.wins, losses = computed.losses,
+matches = computed.matches, opponent_wins = computed.opponent_wins
+FROM computed_player_stats AS computed
+WHERE player_stats.tournament_id = %(tournament)s
+AND computed.tournament_id = %(tournament)s
+AND computed.player = player_stats.player
+"""
+
+# Stats of the players of a batch of matches, and of the earlier opponents
+# of its winners, brought up to date once the batch is inserted. Opponents
+# gain the batch's wins of every player they have played, and players gain
+# the wins, from before the batch, of the opponents they met in it.
+COUNT_RESULTS = """
+WITH batch AS (SELECT unnest(%(winners)s::INTEGER[]) AS winner,
+                      unnest(%(losers)s::INTEGER[]) AS loser),
+results AS (SELECT winner AS player, loser AS opponent, 1 AS won FROM batch
+            UNION ALL
+            SELECT loser, winner, 0 FROM batch),
+gained AS (SELECT player, SUM(won) AS wins, COUNT(*) AS matches
+           FROM results GROUP BY player),
+changes AS (SELECT player, wins, matches, 0 AS opponent_wins FROM gained
+            UNION ALL
+            SELECT results.player, 0, 0, o.wins FROM results
+            JOIN player_stats AS o ON o.player = results.opponent
+            UNION ALL
+            SELECT matches.player2, 0, 0, gained.wins FROM matches
+            JOIN gained ON gained.player = matches.player1
+            WHERE matches.tournament_id = %(tournament)s AND gained.wins > 0
+            UNION ALL
+            SELECT matches.player1, 0, 0, gained.wins FROM matches
+            JOIN gained ON gained.player = matches.player2
+            WHERE matches.tournament_id = %(tournament)s AND gained.wins > 0),
+totals AS (SELECT player, SUM(wins) AS wins, SUM(matches) AS matches,
+           SUM(opponent_wins) AS opponent_wins FROM changes GROUP BY player)
+UPDATE player_stats SET wins = player_stats.wins + totals.wins,
+losses = player_stats.losses + totals.matches - totals.wins,
+matches = player_stats.matches + totals.matches,
+opponent_wins = player_stats.opponent_wins + totals.opponent_wins
+FROM totals WHERE player_stats.player = totals.player
+"""
+
+ADD_MISSING_STATS = """
+INSERT INTO player_stats
+(tournament_id, player, wins, losses, matches, opponent_wins)
+SELECT tournament_id, player, wins, losses, matches, opponent_wins
+FROM computed_player_stats AS computed
+WHERE tournament_id = %(tournament)s AND NOT EXISTS
+(SELECT 1 FROM player_stats WHERE player_stats.player = computed.player)
+"""
+
+# Players registered by registerPlayers(), with their stats rows, in a
+# single statement per page of rows
+REGISTER_PLAYERS = """
+WITH player AS (INSERT INTO players (tournament_id, name) VALUES %s
+                RETURNING tournament_id, id),
+stats AS (INSERT INTO player_stats (tournament_id, player)
+          SELECT tournament_id, id FROM player)
+SELECT id FROM player
+"""
+
+# The tournament created along with the database by tournament.sql
+DEFAULT_TOURNAMENT = 1
+
+# Times a transaction aborted by a deadlock is attempted
+ATTEMPTS = 3
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """A ThreadedConnectionPool that waits for a connection to be returned.
+
+    ThreadedConnectionPool raises PoolError when all maxconn connections are
+    in use. Here getconn() waits until one is returned instead, so any
+    number of threads can share a pool of a few connections.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        ThreadedConnectionPool.__init__(self, minconn, maxconn, *args,
+                                        **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        self.slots.acquire()
+        try:
+            return ThreadedConnectionPool.getconn(self, key)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        ThreadedConnectionPool.putconn(self, conn, key, close)
+        self.slots.release()
+
+
+def createPool(dbname="tournament", minconn=1, maxconn=10):
+    """Returns a pool of up to maxconn connections to the database "dbname".
+
+    Pass it to any number of Tournament objects, including ones used from
+    several threads, to share its connections between them.
+    """
+    return BlockingConnectionPool(minconn, maxconn, "dbname=" + dbname)
 
 
 class Tournament():
     """An object-oriented representation of a single tournament.
 
     This approach reduces the overhead caused by re-connecting on every
-    function call by storing the connection in an object."""
+    function call by keeping connections open in a pool. Each method takes
+    a connection from the pool for the length of one transaction, so an
+    object can be used from several threads at once.
+
+    The database holds any number of tournaments. Each object only sees the
+    players and matches of the one tournament it was opened for."""
+
+    def __init__(self, dbname="tournament", tournament_id=DEFAULT_TOURNAMENT,
+                 pool=None):
+        """Connect to the database "dbname" (defaults to "tournament")
+
+        Args:
+          tournament_id: the id of the tournament to use (defaults to the
+            one created along with the database).
+          pool: a connection pool, such as one made by createPool(), to use
+            instead of opening a pool of this object's own.
+        """
+        self.ownsPool = pool is None
+        self.pool = createPool(dbname) if pool is None else pool
+        self.tournament_id = tournament_id
 
-    def __init__(self, dbname="tournament"):
-        """Connect to the database "dbname" (defaults to "tournament")"""
-        self.db = psycopg2.connect("dbname=" + dbname)
+    @classmethod
+    def create(cls, name, dbname="tournament", pool=None):
+        """Creates a new tournament and returns a Tournament object for it.
+
+        Args:
+          name: the tournament's name (need not be unique).
+        """
+        t = cls(dbname, None, pool)
+        with t.transaction() as cur:
+            cur.execute("INSERT INTO tournaments (name) VALUES (%s) "
+                        "RETURNING id", (name,))
+            t.tournament_id = cur.fetchone()[0]
+
+        return t
 
     def close(self):
-        """closes database stored in the self object"""
-        self.db.close()
+        """Closes the connections of the pool, unless it was passed in."""
+        if self.ownsPool:
+            self.pool.closeall()
+
+    @contextmanager
+    def transaction(self):
+        """Runs the body of a with statement in a transaction.
+
+        Yields a cursor on a connection from the pool. The transaction is
+        committed at the end of the with statement, or rolled back if it
+        raises, and the connection is then returned to the pool.
+        """
+        db = self.pool.getconn()
+        try:
+            with db.cursor() as cur:
+                yield cur
+            db.commit()
+        except Exception:
+            if not db.closed:
+                db.rollback()
+            raise
+        finally:
+            self.pool.putconn(db, close=bool(db.closed))
+
+    def retried(self, f, *args):
+        """Calls f(cursor, *args) in a transaction, retried on deadlocks."""
+        for attempt in range(ATTEMPTS):
+            try:
+                with self.transaction() as cur:
+                    return f(cur, *args)
+            except TransactionRollbackError:
+                if attempt == ATTEMPTS - 1:
+                    raise
+
+    def deleteTournament(self):
+        """Remove the tournament along with its players and matches."""
+
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM tournaments WHERE id = %s",
+                        (self.tournament_id,))
 
     def deleteMatches(self):
-        """Remove all the match records from the database."""
+        """Remove all the match records of the tournament."""
 
-        # Assigning self.db to db purely for convenience
-        db = self.db
-        cur = db.cursor()
-        cur.execute("DELETE FROM matches")
-        db.commit()
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM matches WHERE tournament_id = %s",
+                        (self.tournament_id,))
+            cur.execute("DELETE FROM byes WHERE tournament_id = %s",
+                        (self.tournament_id,))
+            cur.execute("UPDATE player_stats SET wins = 0, losses = 0, "
+                        "matches = 0, opponent_wins = 0 "
+                        "WHERE tournament_id = %s", (self.tournament_id,))
 
     def deletePlayers(self):
-        """Remove all the player records from the database."""
+        """Remove all the player records of the tournament."""
 
-        db = self.db
-        cur = db.cursor()
-        cur.execute("DELETE FROM players")
-        db.commit()
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM players WHERE tournament_id = %s",
+                        (self.tournament_id,))
 
     def countPlayers(self):
         """Returns the number of players currently registered."""
 
-        db = self.db
-        cur = db.cursor()
-        cur.execute("SELECT COUNT(*) as num FROM players")
-        result = cur.fetchone()[0]
+        with self.transaction() as cur:
+            cur.execute("SELECT COUNT(*) as num FROM players "
+                        "WHERE tournament_id = %s", (self.tournament_id,))
+            result = cur.fetchone()[0]
 
         return result
 
     def registerPlayer(self, name):
-        """Adds a player to the tournament database.
+        """Adds a player to the tournament.
 
         The database assigns a unique serial id number for the player.  (This
         should be handled by your SQL database schema, not in your Python
@@ -57,18 +310,41 @@ class Tournament():
         Args:
           name: the player's full name (need not be unique).
         """
-        db = self.db
-        cur = db.cursor()
-        # The extra comma at the end is needed to force Python to treat (name)
-        # as a tuple
-        cur.execute("INSERT INTO players (name) VALUES (%s)", (name,))
-        db.commit()
+        with self.transaction() as cur:
+            cur.execute("WITH player AS "
+                        "(INSERT INTO players (tournament_id, name) "
+                        "VALUES (%s, %s) RETURNING tournament_id, id) "
+                        "INSERT INTO player_stats (tournament_id, player) "
+                        "SELECT tournament_id, id FROM player",
+                        (self.tournament_id, name))
+
+    def registerPlayers(self, names):
+        """Adds many players to the tournament in a single transaction.
+
+        Either every player is registered or, on an error, none is.
+
+        Args:
+          names: an iterable of the players' full names.
+
+        Returns:
+          The ids assigned to the players, in the order of names.
+        """
+        rows = [(self.tournament_id, name) for name in names]
+        if not rows:
+            return []
+
+        with self.transaction() as cur:
+            result = [row[0] for row in execute_values(
+                cur, REGISTER_PLAYERS, rows, page_size=1000, fetch=True)]
+
+        return result
 
     def playerStandings(self):
         """Returns a list of the players and their win records, sorted by wins.
 
         The first entry in the list should be the player in first place, or a
-        player tied for first place if there is currently a tie.
+        player tied for first place if there is currently a tie. Players with
+        as many wins are ordered by the total wins of their opponents.
 
         Returns:
           A list of tuples, each of which contains (id, name, wins, matches):
@@ -76,11 +352,15 @@ class Tournament():
             name: the player's full name (as registered)
             wins: the number of matches the player has won
             matches: the number of matches the player has played
+
+        A bye counts as a match played and won.
         """
-        db = self.db
-        cur = db.cursor()
-        cur.execute("SELECT * FROM standings")
-        result = cur.fetchall()
+        with self.transaction() as cur:
+            cur.execute("SELECT id, name, num_won, num_played FROM standings "
+                        "WHERE tournament_id = %s "
+                        "ORDER BY num_won DESC, opponent_wins DESC, id",
+                        (self.tournament_id,))
+            result = cur.fetchall()
 
         return result
 
@@ -92,19 +372,133 @@ class Tournament():
           loser:  the id number of the player who lost
         """
 
-        db = self.db
-        cur = db.cursor()
-        q = "INSERT INTO matches (player1, player2, winner) VALUES (%s,%s,%s)"
-        cur.execute(q, (winner, loser, winner))
-        db.commit()
+        self.retried(self._reportMatch, {"tournament": self.tournament_id,
+                                         "winner": winner, "loser": loser})
+
+    def _reportMatch(self, cur, players):
+        cur.execute(LOCK_STATS, players)
+        cur.execute("INSERT INTO matches "
+                    "(tournament_id, player1, player2, winner) "
+                    "VALUES (%(tournament)s, %(winner)s, %(loser)s, "
+                    "%(winner)s)", players)
+        cur.execute(ADD_OPPONENT, players)
+        cur.execute(COUNT_RESULT, players)
+        cur.execute(COUNT_OPPONENT_WIN, players)
+
+    def reportBye(self, player):
+        """Records that a player sat out a round, which counts as a win.
+
+        Args:
+          player: the id number of the player given the bye
+        """
+
+        self.retried(self._reportBye, {"tournament": self.tournament_id,
+                                       "winner": player, "loser": player})
+
+    def _reportBye(self, cur, players):
+        cur.execute(LOCK_STATS, players)
+        cur.execute("INSERT INTO byes (tournament_id, player) "
+                    "VALUES (%(tournament)s, %(winner)s)", players)
+        cur.execute(COUNT_BYE, players)
+        cur.execute(COUNT_OPPONENT_WIN, players)
+
+    def reportMatches(self, results):
+        """Records the outcomes of many matches in a single transaction.
+
+        The whole batch is checked before anything is written, and is
+        rejected if any match is invalid, so either every match is recorded
+        or none is. The stats of the players involved are then updated once
+        for the batch, instead of once per match.
+
+        Args:
+          results: an iterable of (winner, loser) pairs of player ids.
+
+        Raises:
+          ValueError: a player plays itself or is not in the tournament, or
+            two players meet again, within the batch or after an earlier match.
+        """
+        results = [(winner, loser) for (winner, loser) in results]
+        if not results:
+            return
+
+        with self.transaction() as cur:
+            # Locking every stats row of the tournament, in order, also
+            # holds off other reports until this one is committed
+            cur.execute("SELECT player FROM player_stats "
+                        "WHERE tournament_id = %s ORDER BY player FOR UPDATE",
+                        (self.tournament_id,))
+            self._checkMatches(cur, results)
+            execute_values(
+                cur, "INSERT INTO matches "
+                "(tournament_id, player1, player2, winner) VALUES %s",
+                [(self.tournament_id, winner, loser, winner)
+                 for (winner, loser) in results], page_size=1000)
+            cur.execute(COUNT_RESULTS, {
+                "tournament": self.tournament_id,
+                "winners": [winner for (winner, loser) in results],
+                "losers": [loser for (winner, loser) in results]})
+
+    def _checkMatches(self, cur, results):
+        """Raises ValueError listing the invalid matches in results."""
+        players = set(player for match in results for player in match)
+        cur.execute("SELECT id FROM players "
+                    "WHERE tournament_id = %s AND id = ANY(%s)",
+                    (self.tournament_id, list(players)))
+        registered = set(row[0] for row in cur.fetchall())
+        cur.execute("SELECT player1, player2 FROM matches "
+                    "WHERE tournament_id = %s "
+                    "AND (player1 = ANY(%s) OR player2 = ANY(%s))",
+                    (self.tournament_id, list(players), list(players)))
+        played = set(frozenset(pair) for pair in cur.fetchall())
+
+        errors = []
+        for (winner, loser) in results:
+            if winner == loser:
+                errors.append("%s cannot play itself" % winner)
+            elif winner not in registered or loser not in registered:
+                errors.append("%s vs %s: not both in this tournament" %
+                              (winner, loser))
+            elif frozenset((winner, loser)) in played:
+                errors.append("%s vs %s: a rematch" % (winner, loser))
+            played.add(frozenset((winner, loser)))
+        if errors:
+            raise ValueError("Invalid matches: " + "; ".join(errors))
+
+    def checkPlayerStats(self):
+        """Returns the ids of players whose stored stats are out of date.
+
+        The stats kept in player_stats are compared with the ones computed
+        from scratch from every match, so this is as slow as standings used
+        to be. An empty list means player_stats is correct.
+        """
+        with self.transaction() as cur:
+            cur.execute(WRONG_STATS, {"tournament": self.tournament_id})
+            result = [row[0] for row in cur.fetchall()]
+
+        return result
+
+    def rebuildPlayerStats(self):
+        """Recomputes the stats of every player from the matches.
+
+        The tournament's stats rows are locked while they are rebuilt, so
+        its matches cannot be reported in the meantime.
+        """
+        with self.transaction() as cur:
+            cur.execute("SELECT player FROM player_stats "
+                        "WHERE tournament_id = %s ORDER BY player FOR UPDATE",
+                        (self.tournament_id,))
+            cur.execute(REBUILD_STATS, {"tournament": self.tournament_id})
+            cur.execute(ADD_MISSING_STATS, {"tournament": self.tournament_id})
 
     def swissPairings(self):
         """Returns a list of pairs of players for the next round of a match.
 
-        Assuming that there are an even number of players registered, each
-        player appears exactly once in the pairings.  Each player is paired
-        with another player with an equal or nearly-equal win record, that is,
-        a player adjacent to him or her in the standings.
+        Each player appears exactly once in the pairings.  Each player is
+        paired with another player with an equal or nearly-equal win record,
+        and never with a player they have already played, see
+        pairing.swissPairings().  With an odd number of players, the last
+        tuple is the player given a bye, with None for the second player;
+        record it with reportBye().
 
         Returns:
           A list of tuples, each of which contains (id1, name1, id2, name2)
@@ -112,11 +506,82 @@ class Tournament():
             name1: the first player's name
             id2: the second player's unique id
             name2: the second player's name
+
+        Raises:
+          pairing.PairingError: the players cannot all be paired without a
+            rematch.
         """
 
-        db = self.db
-        cur = db.cursor()
-        cur.execute("SELECT * FROM swiss_pairings")
-        result = cur.fetchall()
+        with self.transaction() as cur:
+            cur.execute("SELECT id, name, num_won FROM standings "
+                        "WHERE tournament_id = %s "
+                        "ORDER BY num_won DESC, opponent_wins DESC, id",
+                        (self.tournament_id,))
+            standings = cur.fetchall()
+            cur.execute("SELECT player1, player2 FROM matches "
+                        "WHERE tournament_id = %s", (self.tournament_id,))
+            played = set(frozenset(row) for row in cur.fetchall())
+            cur.execute("SELECT player, COUNT(*) FROM byes "
+                        "WHERE tournament_id = %s GROUP BY player",
+                        (self.tournament_id,))
+            byes = dict(cur.fetchall())
+
+        names = dict((row[0], row[1]) for row in standings)
+        pairs, bye = pairing.swissPairings(
+            [(row[0], row[2]) for row in standings], played, byes)
+        result = [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+        if bye is not None:
+            result.append((bye, names[bye], None, None))
 
         return result
+
+
+class AsyncTournament():
+    """Runs the methods of a Tournament on a pool of threads.
+
+    Every method of the Tournament can be called on this object with the
+    same arguments, and returns at once with a
+    multiprocessing.pool.AsyncResult. Its get() method waits for and returns
+    the result, or raises the method's exception. Services that must not
+    block, such as event loops, can start calls and collect them later,
+    while each call waits for its database connection on a thread of its
+    own.
+
+    Use a Tournament with a pool of at least as many connections as threads.
+    """
+
+    def __init__(self, tournament, threads=8):
+        self.tournament = tournament
+        self.threads = ThreadPool(threads)
+
+    def __getattr__(self, name):
+        method = getattr(self.tournament, name)
+
+        def call(*args, **kwargs):
+            return self.threads.apply_async(method, args, kwargs)
+        return call
+
+    def close(self):
+        """Waits for the calls started and closes the Tournament."""
+        self.threads.close()
+        self.threads.join()
+        self.tournament.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("check", "rebuild"):
+        sys.exit("Usage: python tournament.py check|rebuild [tournament id]")
+
+    t = Tournament(tournament_id=int(sys.argv[2]) if len(sys.argv) > 2
+                   else DEFAULT_TOURNAMENT)
+    if sys.argv[1] == "check":
+        wrong = t.checkPlayerStats()
+        for player in wrong:
+            print("Player %d: stats out of date" % player)
+        print("%d players out of date" % len(wrong))
+        t.close()
+        sys.exit(1 if wrong else 0)
+
+    t.rebuildPlayerStats()
+    print("Player stats rebuilt")
+    t.close()
@@ -12,45 +12,142 @@ CREATE DATABASE tournament;
 
 \c tournament
 
--- Players table
-CREATE TABLE players (
+-- Tournaments, each an event with its own players and matches. Every
+-- query of tournament.py is limited to one tournament, and the indexes below
+-- all start with tournament_id, so an event's standings and pairings only
+-- touch its own rows however many other events are stored.
+CREATE TABLE tournaments (
     id SERIAL PRIMARY KEY,
     name TEXT
 );
 
+-- The tournament used by Tournament() unless another one is given
+INSERT INTO tournaments (name) VALUES ('Default');
+
+-- Players table, with a row per player registered in a tournament
+CREATE TABLE players (
+    id SERIAL PRIMARY KEY,
+    tournament_id INTEGER NOT NULL REFERENCES tournaments(id)
+        ON DELETE CASCADE,
+    name TEXT,
+    -- Lets matches check that both players are in their tournament
+    UNIQUE (tournament_id, id)
+);
+
 -- Matches table
 CREATE TABLE matches (
-    player1 INTEGER REFERENCES players(id),
-    player2 INTEGER REFERENCES players(id),
-    winner INTEGER REFERENCES players(id),
+    tournament_id INTEGER NOT NULL,
+    player1 INTEGER NOT NULL,
+    player2 INTEGER NOT NULL,
+    winner INTEGER,
     -- Re-matches are not allowed
-    PRIMARY KEY (player1, player2)
+    PRIMARY KEY (tournament_id, player1, player2),
+    FOREIGN KEY (tournament_id, player1) REFERENCES players(tournament_id, id)
+        ON DELETE CASCADE,
+    FOREIGN KEY (tournament_id, player2) REFERENCES players(tournament_id, id)
+        ON DELETE CASCADE,
+    FOREIGN KEY (tournament_id, winner) REFERENCES players(tournament_id, id)
+        ON DELETE CASCADE
 );
 
--- Number of wins for a player
-CREATE VIEW player_wins AS SELECT players.id, COUNT(matches.winner) AS num_won
-FROM players LEFT JOIN matches ON players.id = matches.winner
-GROUP BY players.id ORDER BY num_won DESC;
+-- Matches are looked up by either player, and by winner
+CREATE INDEX matches_player2 ON matches (tournament_id, player2);
+CREATE INDEX matches_winner ON matches (tournament_id, winner);
+
+-- Rounds players sat out because of an odd number of players, each counted
+-- as a won match
+CREATE TABLE byes (
+    id SERIAL PRIMARY KEY,
+    tournament_id INTEGER NOT NULL,
+    player INTEGER NOT NULL,
+    FOREIGN KEY (tournament_id, player) REFERENCES players(tournament_id, id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX byes_player ON byes (tournament_id, player);
+
+-- Each player's record, kept up to date by tournament.py in the same
+-- transaction as the match it counts, so that standings never have to
+-- aggregate the whole match history. opponent_wins, the sum of the wins of
+-- every opponent played, breaks ties between players with as many wins.
+CREATE TABLE player_stats (
+    player INTEGER PRIMARY KEY,
+    tournament_id INTEGER NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    matches INTEGER NOT NULL DEFAULT 0,
+    opponent_wins INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (tournament_id, player) REFERENCES players(tournament_id, id)
+        ON DELETE CASCADE
+);
+
+-- A tournament's standings in order, read straight from the index
+CREATE INDEX player_stats_standings ON player_stats
+(tournament_id, wins DESC, opponent_wins DESC, player);
+
+-- Every match once from each player's side
+CREATE VIEW match_results AS
+SELECT tournament_id, player1 AS player, player2 AS opponent,
+       (winner = player1)::INTEGER AS won FROM matches
+UNION ALL
+SELECT tournament_id, player2, player1, (winner = player2)::INTEGER
+FROM matches;
+
+-- Everything that counts towards a player's record: a row per player, one
+-- per match and bye they had, and one per win, in a match or by a bye, of
+-- each opponent they played
+CREATE VIEW player_record_parts AS
+SELECT tournament_id, id AS player, 0 AS wins, 0 AS matches,
+       0 AS opponent_wins FROM players
+UNION ALL
+SELECT tournament_id, player, won, 1, 0 FROM match_results
+UNION ALL
+SELECT tournament_id, player, 1, 1, 0 FROM byes
+UNION ALL
+SELECT results.tournament_id, results.player, 0, 0, 1
+FROM match_results AS results JOIN matches AS won
+ON won.tournament_id = results.tournament_id
+AND won.winner = results.opponent
+UNION ALL
+SELECT results.tournament_id, results.player, 0, 0, 1
+FROM match_results AS results JOIN byes
+ON byes.tournament_id = results.tournament_id
+AND byes.player = results.opponent;
 
--- Number of matches played by a player
-CREATE VIEW player_matches AS SELECT players.id, COUNT(matches.*) AS num_played
-FROM players LEFT JOIN matches ON matches.player1 = players.id
-OR matches.player2 = players.id GROUP BY players.id
-ORDER BY num_played DESC;
+-- The player_stats records computed from scratch from the matches, used to
+-- check and rebuild player_stats. Views rather than WITH queries, so that
+-- filtering on tournament_id only reads that tournament's matches. The
+-- parts are added up in a single GROUP BY, so every match is read a few
+-- times however many players there are.
+CREATE VIEW computed_player_stats AS
+SELECT tournament_id, player, SUM(wins)::INTEGER AS wins,
+       SUM(matches - wins)::INTEGER AS losses,
+       SUM(matches)::INTEGER AS matches,
+       SUM(opponent_wins)::INTEGER AS opponent_wins
+FROM player_record_parts GROUP BY tournament_id, player;
 
--- Player's current standings
-CREATE VIEW standings AS SELECT players.id, players.name, player_wins.num_won,
-player_matches.num_played FROM players JOIN player_wins ON
-player_wins.id = players.id JOIN player_matches
-ON player_matches.id = players.id ORDER BY player_wins.num_won;
+-- Player's current standings, best first within each tournament
+CREATE VIEW standings AS SELECT player_stats.tournament_id, players.id,
+players.name, player_stats.wins AS num_won, player_stats.matches AS num_played,
+player_stats.opponent_wins
+FROM players JOIN player_stats ON player_stats.player = players.id
+ORDER BY player_stats.tournament_id, player_stats.wins DESC,
+player_stats.opponent_wins DESC, players.id;
 
 -- Simple numbered standings view used in the pairing process so it does not
--- have to be repeated in swiss-pairing
+-- have to be repeated in swiss-pairing. Players are numbered within their
+-- tournament.
 
-CREATE VIEW numbered_standings AS SELECT *, ROW_NUMBER() OVER() as num FROM standings;
+CREATE VIEW numbered_standings AS SELECT *, ROW_NUMBER() OVER (
+PARTITION BY tournament_id ORDER BY num_won DESC, opponent_wins DESC, id)
+AS num FROM standings;
 
 
--- Result for swiss-style pairing done in the database.
-CREATE VIEW swiss_pairings AS SELECT a.id AS id1, a.name AS name1, b.id AS id2,
-b.name as name2 FROM numbered_standings AS a, numbered_standings AS b WHERE
-a.num = b.num - 1 AND a.num % 2 = 1 ORDER BY a.num_won DESC;
+-- Result for swiss-style pairing done in the database. tournament.py now
+-- pairs players with pairing.py, which avoids rematches and handles byes;
+-- this view is kept to compare the two, see benchmark.py.
+CREATE VIEW swiss_pairings AS SELECT a.tournament_id, a.id AS id1,
+a.name AS name1, b.id AS id2, b.name as name2
+FROM numbered_standings AS a, numbered_standings AS b
+WHERE a.tournament_id = b.tournament_id AND a.num = b.num - 1
+AND a.num % 2 = 1 ORDER BY a.tournament_id, a.num;
@@ -2,6 +2,8 @@
 #
 # Test cases for tournament.py
 
+import threading
+
 import tournament
 
 
@@ -168,6 +170,203 @@ def testPairings():
     print "9. After one match, players with one win are paired."
 
 
+def testPlayerStats():
+    t = tournament.Tournament()
+
+    t.deleteMatches()
+    t.deletePlayers()
+    for name in ("Ada", "Grace", "Edsger", "Barbara"):
+        t.registerPlayer(name)
+    [id1, id2, id3, id4] = sorted(row[0] for row in t.playerStandings())
+    t.reportMatch(id1, id2)
+    t.reportMatch(id3, id4)
+    t.reportMatch(id1, id3)
+    t.reportMatch(id4, id2)
+    standings = [(i, w, m) for (i, n, w, m) in t.playerStandings()]
+    # id3 and id4 have one win each, but id3 lost to the leader
+    if standings != [(id1, 2, 2), (id3, 1, 2), (id4, 1, 2), (id2, 0, 2)]:
+        raise ValueError(
+            "Standings should be ordered by wins, then opponents' wins.")
+    if t.checkPlayerStats() != []:
+        raise ValueError("Stored stats should match the matches played.")
+
+    with t.transaction() as cur:
+        cur.execute("UPDATE player_stats SET wins = 5 WHERE player = %s",
+                    (id2,))
+    if t.checkPlayerStats() != [id2]:
+        raise ValueError("Stats out of date should be found by the check.")
+    t.rebuildPlayerStats()
+    if t.checkPlayerStats() != [] or t.playerStandings()[-1][2] != 0:
+        raise ValueError("Rebuilding should recompute every player's stats.")
+
+    t.close()
+    print "10. Player stats are kept up to date and can be rebuilt."
+
+
+def testSeparateTournaments():
+    t = tournament.Tournament()
+    other = tournament.Tournament.create("Spring Open")
+
+    t.deleteMatches()
+    t.deletePlayers()
+    t.registerPlayer("Ada")
+    t.registerPlayer("Grace")
+    for name in ("Edsger", "Barbara", "Donald", "Frances"):
+        other.registerPlayer(name)
+    if t.countPlayers() != 2 or other.countPlayers() != 4:
+        raise ValueError("Each tournament should count its own players.")
+
+    [id1, id2] = [row[0] for row in t.playerStandings()]
+    [id3, id4, id5, id6] = [row[0] for row in other.playerStandings()]
+    other.reportMatch(id3, id4)
+    other.reportMatch(id5, id6)
+    if [row[3] for row in t.playerStandings()] != [0, 0]:
+        raise ValueError("Matches should only count in their tournament.")
+    if len(other.swissPairings()) != 2 or len(t.swissPairings()) != 1:
+        raise ValueError("Players should only be paired within their "
+                         "tournament.")
+    try:
+        t.reportMatch(id1, id3)
+    except tournament.psycopg2.IntegrityError:
+        pass
+    else:
+        raise ValueError("Players of another tournament should not be "
+                         "matched.")
+
+    other.deleteTournament()
+    if other.countPlayers() != 0 or t.countPlayers() != 2:
+        raise ValueError("Deleting a tournament should delete only its "
+                         "players.")
+
+    other.close()
+    t.close()
+    print "11. Tournaments keep their players and matches apart."
+
+
+def testBatches():
+    t = tournament.Tournament()
+
+    t.deleteMatches()
+    t.deletePlayers()
+    names = ["Player %d" % i for i in range(8)]
+    ids = t.registerPlayers(names)
+    if len(ids) != 8 or t.countPlayers() != 8 or \
+            sorted((i, n) for (i, n, w, m) in t.playerStandings()) != \
+            sorted(zip(ids, names)):
+        raise ValueError("registerPlayers should return the new players' "
+                         "ids in order.")
+
+    t.reportMatches(zip(ids[0::2], ids[1::2]))
+    standings = t.playerStandings()
+    if [m for (i, n, w, m) in standings] != [1] * 8 or \
+            set(i for (i, n, w, m) in standings[:4]) != set(ids[0::2]):
+        raise ValueError("reportMatches should record every match.")
+    if t.checkPlayerStats() != []:
+        raise ValueError("reportMatches should keep player stats correct.")
+
+    try:
+        t.reportMatches([(ids[0], ids[2]), (ids[1], ids[0])])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A batch with a rematch should be rejected.")
+    if [m for (i, n, w, m) in t.playerStandings()] != [1] * 8:
+        raise ValueError("No match of a rejected batch should be recorded.")
+
+    t.close()
+    print "12. Players and matches can be recorded in batches."
+
+
+def testOddPairings():
+    t = tournament.Tournament()
+
+    t.deleteMatches()
+    t.deletePlayers()
+    t.registerPlayers(["Alice", "Bob", "Carol", "Dave", "Erin"])
+    played = set()
+    byes = []
+    for round in range(4):
+        pairings = t.swissPairings()
+        if len(pairings) != 3 or pairings[-1][2] is not None:
+            raise ValueError("For five players, swissPairings should return "
+                             "two pairs and a bye.")
+        for (id1, name1, id2, name2) in pairings[:-1]:
+            if frozenset([id1, id2]) in played:
+                raise ValueError("Players should never be paired twice.")
+            played.add(frozenset([id1, id2]))
+            t.reportMatch(id1, id2)
+        byes.append(pairings[-1][0])
+        t.reportBye(pairings[-1][0])
+    if len(set(byes)) != 4:
+        raise ValueError("No player should get a second bye before every "
+                         "player has had one.")
+    if [m for (i, n, w, m) in t.playerStandings()] != [4] * 5 or \
+            t.checkPlayerStats() != []:
+        raise ValueError("A bye should count as a match won.")
+
+    t.close()
+    print "13. Odd fields get fair byes and players never meet twice."
+
+
+def testConcurrency():
+    pool = tournament.createPool(maxconn=8)
+    t = tournament.Tournament.create("Concurrency test", pool=pool)
+    errors = []
+
+    def run(f, *args):
+        try:
+            f(*args)
+        except Exception as e:
+            errors.append(e)
+
+    def report(pairs):
+        for (id1, name1, id2, name2) in pairs:
+            t.reportMatch(id1, id2)
+
+    def read(done):
+        while not done.is_set():
+            if len(t.playerStandings()) != 64:
+                raise ValueError("Standings should list every player.")
+
+    t.registerPlayers(["Player %d" % i for i in range(64)])
+    for round in range(4):
+        pairings = t.swissPairings()
+        done = threading.Event()
+        readers = [threading.Thread(target=run, args=(read, done))
+                   for _ in range(8)]
+        # Many more threads than connections, each reporting two matches
+        writers = [threading.Thread(target=run,
+                                    args=(report, pairings[i:i + 2]))
+                   for i in range(0, len(pairings), 2)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+    if errors:
+        raise errors[0]
+    if [m for (i, n, w, m) in t.playerStandings()] != [4] * 64 or \
+            t.checkPlayerStats() != []:
+        raise ValueError("Matches reported from many threads at once should "
+                         "all be counted.")
+
+    a = tournament.AsyncTournament(t, threads=4)
+    results = [a.playerStandings() for _ in range(16)]
+    if any(len(result.get()) != 64 for result in results):
+        raise ValueError("AsyncTournament should return the results of "
+                         "Tournament's methods.")
+    if a.countPlayers().get() != 64:
+        raise ValueError("AsyncTournament should return the results of "
+                         "Tournament's methods.")
+
+    t.deleteTournament()
+    a.close()
+    pool.closeall()
+    print "14. Many threads can report matches and read standings at once."
+
+
 if __name__ == '__main__':
     testDeleteMatches()
     testDelete()
@@ -177,4 +376,9 @@ if __name__ == '__main__':
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testPlayerStats()
+    testSeparateTournaments()
+    testBatches()
+    testOddPairings()
+    testConcurrency()
     print "Success!  All tests pass!"